@@ -1,9 +1,56 @@
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageStat, ImageEnhance
+import argparse
 import os
+import posixpath
 import random
 import math
+import mmap
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import csv
+import functools
+import importlib
+import io
+import itertools
+import json
+import queue
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+class _LazyModule:
+    """
+    Заглушка модуля: настоящий импорт - при первом обращении к атрибуту,
+    после чего глобальное имя alias заменяется самим модулем (дальше без
+    накладных расходов). Команды CLI, которым не нужны numpy или Pillow,
+    стартуют без их импорта.
+    """
+    
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+# Тяжелые модули: импортируются лениво (см. _LazyModule)
+Image = _LazyModule('PIL.Image', 'Image')
+ImageDraw = _LazyModule('PIL.ImageDraw', 'ImageDraw')
+ImageFont = _LazyModule('PIL.ImageFont', 'ImageFont')
+ImageFilter = _LazyModule('PIL.ImageFilter', 'ImageFilter')
+ImageStat = _LazyModule('PIL.ImageStat', 'ImageStat')
+ImageEnhance = _LazyModule('PIL.ImageEnhance', 'ImageEnhance')
+ImageChops = _LazyModule('PIL.ImageChops', 'ImageChops')
+features = _LazyModule('PIL.features', 'features')
+np = _LazyModule('numpy', 'np')
+asyncio = _LazyModule('asyncio', 'asyncio')
 
 # =============================================================================
 # ЧАСТЬ 1: БАЗОВЫЕ ОПЕРАЦИИ И ИСПРАВЛЕНИЕ БАГОВ
@@ -19,83 +66,627 @@ def basic_operations_demo():
         create_test_images()
     
     try:
-        # 1. Открываем изображение
-        image = Image.open("./input/photo1.jpg")
+        # 1. Открываем изображение (читается только заголовок)
+        source = Image.open("./input/photo1.jpg")
         
         # 2. Показываем информацию о изображении
-        print(f"Формат: {image.format}")
-        print(f"Размер: {image.size}")
-        print(f"Режим: {image.mode}")
-        
-        # 3. Сохраняем в другом формате
-        image.save("./output/photo1_basic.png")
-        
-        # 4. Изменяем размер
-        new_size = (400, int(image.height * 400 / image.width))
-        resized_image = image.resize(new_size, Image.Resampling.LANCZOS)
+        print(f"Формат: {source.format}")
+        print(f"Размер: {source.size}")
+        print(f"Режим: {source.mode}")
         
-        # 5. Поворачиваем
-        rotated_image = image.rotate(45, expand=True)
-        
-        # 6. Конвертируем в черно-белое
-        grayscale_image = image.convert("L")
-        
-        # 7. Обрезаем изображение
-        cropped_image = image.crop((100, 100, 400, 400))
-        
-        # Сохраняем результаты
-        resized_image.save("./output/photo1_resized.jpg")
-        rotated_image.save("./output/photo1_rotated.jpg")
-        grayscale_image.save("./output/photo1_bw.jpg")
-        cropped_image.save("./output/photo1_cropped.jpg")
+        # 3-7. Копия в PNG, размер 400px, поворот, ч/б и обрезка: кадр из
+        # кэша (JPEG не декодируется повторно), варианты кодируются параллельно
+        render_renditions("./input/photo1.jpg", "./output", BASIC_RENDITIONS,
+                          frame_cache=get_frame_cache())
         
         print("Базовые операции завершены!")
         
     except Exception as e:
         print(f"Ошибка в базовых операциях: {e}")
 
-def create_test_images():
+# Варианты basic_operations_demo в виде спецификаций render_renditions
+BASIC_RENDITIONS = (
+    {'name': 'basic', 'ext': '.png'},
+    {'name': 'resized', 'width': 400},
+    {'name': 'rotated', 'rotate': 45},
+    {'name': 'bw', 'grayscale': True},
+    {'name': 'cropped', 'crop': (100, 100, 400, 400)}
+)
+
+# Типовой набор вариантов одной загрузки
+PRODUCT_RENDITIONS = (
+    {'name': 'original', 'preset': 'balanced'},
+    {'name': 'xl', 'width': 2048},
+    {'name': 'large', 'width': 1280},
+    {'name': 'medium', 'width': 800},
+    {'name': 'small', 'width': 480},
+    {'name': 'thumb', 'crop_square': True, 'width': 200, 'height': 200},
+    {'name': 'thumb_webp', 'crop_square': True, 'width': 200, 'height': 200, 'ext': '.webp'},
+    {'name': 'square', 'crop_square': True, 'width': 600},
+    {'name': 'square_small', 'crop_square': True, 'width': 150},
+    {'name': 'preview_bw', 'width': 640, 'grayscale': True},
+    {'name': 'icon', 'crop_square': True, 'width': 64, 'height': 64, 'ext': '.png'},
+    {'name': 'rotated', 'width': 400, 'rotate': 90}
+)
+
+# Во сколько раз уровень пирамиды (и draft JPEG) должен быть больше варианта:
+# запас, с которым финальный LANCZOS неотличим от LANCZOS с полного кадра
+RENDITION_REDUCING_GAP = 2.0
+
+def _rendition_geometry(spec, source_size):
+    """
+    Область источника (crop) и итоговый размер варианта.
+    crop - прямоугольник в пикселях источника, crop_square - центральный квадрат;
+    width/height: оба - точный размер, один - второй по пропорции, ни одного - 1:1.
+    """
+    width, height = source_size
+    if spec.get('crop'):
+        box = tuple(spec['crop'])
+    elif spec.get('crop_square'):
+        side = min(width, height)
+        left, top = (width - side) // 2, (height - side) // 2
+        box = (left, top, left + side, top + side)
+    else:
+        box = (0, 0, width, height)
+    crop_w, crop_h = box[2] - box[0], box[3] - box[1]
+    target_w, target_h = spec.get('width'), spec.get('height')
+    if target_w and target_h:
+        size = (target_w, target_h)
+    elif target_w:
+        size = (target_w, max(1, round(crop_h * target_w / crop_w)))
+    elif target_h:
+        size = (max(1, round(crop_w * target_h / crop_h)), target_h)
+    else:
+        size = (crop_w, crop_h)
+    return box, size, max(size[0] / crop_w, size[1] / crop_h)
+
+def build_pyramid(img, min_scale):
+    """
+    Пирамида уменьшений: исходник и его половины через reduce(2) (box-
+    усреднение), пока следующий уровень не меньше min_scale. Возвращает
+    [(масштаб уровня относительно img, уровень)] от большего к меньшему.
+    """
+    levels = [(1.0, img)]
+    while levels[-1][0] / 2 >= min_scale and min(levels[-1][1].size) >= 2:
+        levels.append((levels[-1][0] / 2, levels[-1][1].reduce(2)))
+    return levels
+
+def _render_rendition(levels, source_size, spec, output_path):
+    """
+    Один вариант с наименьшего уровня пирамиды, который больше варианта хотя
+    бы в RENDITION_REDUCING_GAP раз: обрезка и масштаб за один LANCZOS
+    resize(box=...), ч/б и поворот - уже на итоговом размере. Без resize
+    обходится только вариант в масштабе 1:1 с исходными пикселями.
+    Кодирование и запись тоже здесь (в потоке пула).
+    """
+    start_time = time.perf_counter()
+    box, size, scale = _rendition_geometry(spec, source_size)
+    wanted = min(scale * RENDITION_REDUCING_GAP, 1.0)
+    level_scale, level = next(((s, lvl) for s, lvl in reversed(levels) if s >= wanted - 1e-9),
+                              levels[0])
+    # Масштаб уровня относительно источника по каждой оси (уровни округлены до пикселя)
+    kx, ky = level.width / source_size[0], level.height / source_size[1]
+    level_box = (box[0] * kx, box[1] * ky, box[2] * kx, box[3] * ky)
+    # Уровни пирамиды и draft - box-усреднение, а не LANCZOS: напрямую
+    # сохраняются только исходные пиксели
+    if level_scale != 1.0:
+        img = level.resize(size, Image.Resampling.LANCZOS, box=level_box)
+    elif level_box == (0, 0, level.width, level.height) and size == level.size:
+        img = level
+    elif all(float(v).is_integer() for v in level_box) and \
+            size == (level_box[2] - level_box[0], level_box[3] - level_box[1]):
+        img = level.crop(tuple(int(v) for v in level_box))
+    else:
+        img = level.resize(size, Image.Resampling.LANCZOS, box=level_box)
+    if spec.get('grayscale'):
+        img = img.convert('L')
+    if spec.get('rotate'):
+        img = img.rotate(spec['rotate'], expand=True)
+    
+    fmt = output_format(output_path)
+    data = encode_image(img, fmt, spec.get('preset')).getbuffer()
+    LocalFiles.write(output_path, data)
+    return {'name': spec['name'], 'path': output_path, 'size': img.size, 'bytes': len(data),
+            'level_scale': level_scale, 'seconds': time.perf_counter() - start_time}
+
+def render_renditions(source, output_folder, specs=PRODUCT_RENDITIONS, max_workers=4,
+                      stem=None, frame_cache=None):
+    """
+    Набор вариантов одной загрузки (спецификации - словари, см. PRODUCT_RENDITIONS):
+    - источник декодируется один раз; JPEG - сразу в наименьшем масштабе
+      (draft), который больше самого большого варианта в RENDITION_REDUCING_GAP раз
+    - строится пирамида половинных уменьшений, каждый вариант доводится
+      LANCZOS с уровня, больше него в RENDITION_REDUCING_GAP раз, а не с полного кадра
+    - обрезки и ч/б считаются на самом маленьком подходящем уровне
+    - варианты строятся и кодируются параллельно в пуле потоков
+    source - путь или уже декодированное изображение. Файлы: <stem>_<name><ext>.
+    frame_cache - FrameCache: полный кадр пути берется из кэша без декодирования
+    (выгодно, когда файл обрабатывается повторно; draft тогда не нужен).
+    Возвращает варианты и время: wall (задержка загрузки) и cpu (процессорное).
+    """
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    os.makedirs(output_folder, exist_ok=True)
+    
+    decoded = isinstance(source, Image.Image) or frame_cache is not None
+    if isinstance(source, Image.Image):
+        img = source
+        stem = stem or 'image'
+    else:
+        img = frame_cache.get(source) if frame_cache is not None else Image.open(source)
+        stem = stem or os.path.splitext(os.path.basename(source))[0]
+    source_size = img.size
+    scales = [_rendition_geometry(spec, source_size)[2] for spec in specs]
+    
+    if not decoded:
+        max_scale = min(max(scales) * RENDITION_REDUCING_GAP, 1.0)
+        if img.format == 'JPEG':
+            img.draft('RGB', (math.ceil(source_size[0] * max_scale),
+                              math.ceil(source_size[1] * max_scale)))
+        img.load()
+    if img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGB')
+    decode_seconds = time.perf_counter() - wall_start
+    
+    # Пирамида считается от декодированного кадра (после draft он уже меньше)
+    decoded_scale = img.width / source_size[0]
+    levels = [(s * decoded_scale, level) for s, level
+              in build_pyramid(img, min(scales) * RENDITION_REDUCING_GAP / decoded_scale)]
+    
+    paths = [os.path.join(output_folder, f"{stem}_{spec['name']}{spec.get('ext', '.jpg')}")
+             for spec in specs]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        renditions = list(executor.map(_render_rendition, itertools.repeat(levels),
+                                       itertools.repeat(source_size), specs, paths))
+    return {
+        'renditions': renditions,
+        'decode_seconds': decode_seconds,
+        'pyramid_levels': len(levels),
+        'wall_seconds': time.perf_counter() - wall_start,
+        'cpu_seconds': time.process_time() - cpu_start
+    }
+
+def render_renditions_naive(path, output_folder, specs=PRODUCT_RENDITIONS):
+    """Каждый вариант с полного кадра и по очереди (эталон для benchmark_renditions)"""
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    stem = os.path.splitext(os.path.basename(path))[0]
+    with Image.open(path) as source:
+        full = source.convert('RGB')
+    for spec in specs:
+        box, size, _ = _rendition_geometry(spec, full.size)
+        img = full.crop(box)
+        if img.size != size:
+            img = img.resize(size, Image.Resampling.LANCZOS)
+        if spec.get('grayscale'):
+            img = img.convert('L')
+        if spec.get('rotate'):
+            img = img.rotate(spec['rotate'], expand=True)
+        save_image(img, os.path.join(output_folder,
+                                     f"{stem}_{spec['name']}{spec.get('ext', '.jpg')}"),
+                   spec.get('preset'))
+    return {'wall_seconds': time.perf_counter() - wall_start,
+            'cpu_seconds': time.process_time() - cpu_start}
+
+def benchmark_renditions(source_size=(4000, 3000), specs=PRODUCT_RENDITIONS, repeat=3,
+                         max_workers=4, work_dir="./output/bench_renditions"):
+    """
+    Задержка (wall) и процессорное время (cpu) на одну загрузку: пирамида с
+    параллельным кодированием против вариантов с полного кадра по очереди
+    """
+    print("\n=== БЕНЧМАРК ВАРИАНТОВ ЗАГРУЗКИ ===")
+    
+    os.makedirs(work_dir, exist_ok=True)
+    path = os.path.join(work_dir, f"upload_{source_size[0]}x{source_size[1]}.jpg")
+    if not os.path.exists(path):
+        base = create_gradient(source_size, [(0.0, (200, 150, 120)), (1.0, (40, 60, 150))],
+                               kind='radial')
+        noise = Image.effect_noise(source_size, 40).convert('RGB')
+        Image.blend(base, noise, 0.2).save(path, quality=90)
+    
+    results = {}
+    for name, func in (
+        ('naive', lambda: render_renditions_naive(path, os.path.join(work_dir, 'naive'), specs)),
+        ('pyramid', lambda: render_renditions(path, os.path.join(work_dir, 'pyramid'), specs,
+                                              max_workers))
+    ):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+        runs = [func() for _ in range(repeat)]
+        results[name] = {
+            'wall_p50': percentile([run['wall_seconds'] for run in runs], 50),
+            'cpu_p50': percentile([run['cpu_seconds'] for run in runs], 50)
+        }
+        print(f"{name:>8}: задержка {results[name]['wall_p50']*1000:.0f} мс, "
+              f"CPU {results[name]['cpu_p50']*1000:.0f} мс на загрузку "
+              f"({len(specs)} вариантов)")
+    return results
+
+def test_block_pattern(width=800, height=600, shift=(0, 0, 0), block=10):
+    """
+    Узор тестового изображения из блоков block x block: цвет блока зависит от
+    его угла, R - от x, G - от y, B - от x + y. Считается один пиксель на блок
+    (широковещанием строки и столбца), затем целочисленное NEAREST-увеличение
+    и обрезка краевых блоков - без отрисовки прямоугольников по одному.
+    """
+    x = np.arange(0, width, block)
+    y = np.arange(0, height, block)
+    blocks = np.empty((len(y), len(x), 3), dtype=np.uint8)
+    blocks[:, :, 0] = ((x + shift[0]) % 255)[np.newaxis, :]
+    blocks[:, :, 1] = ((y + shift[1]) % 255)[:, np.newaxis]
+    blocks[:, :, 2] = (y[:, np.newaxis] + x[np.newaxis, :] + shift[2]) % 255
+    img = Image.fromarray(blocks, 'RGB').resize((len(x) * block, len(y) * block),
+                                                 Image.Resampling.NEAREST)
+    return img if img.size == (width, height) else img.crop((0, 0, width, height))
+
+def create_test_images(folder="./input", count=3):
     """Создает тестовые изображения если их нет"""
     print("Создание тестовых изображений...")
-    for i in range(3):
-        # Создаем градиентные изображения
-        img = Image.new('RGB', (800, 600), color='white')
-        draw = ImageDraw.Draw(img)
-        
-        for x in range(0, 800, 10):
-            for y in range(0, 600, 10):
-                color = (
-                    (x + i*100) % 255,
-                    (y + i*50) % 255, 
-                    (x + y + i*30) % 255
-                )
-                draw.rectangle([x, y, x+9, y+9], fill=color)
-        
-        img.save(f"./input/photo{i+1}.jpg")
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        # Блочный градиент, сдвинутый для каждого изображения
+        img = test_block_pattern(800, 600, (i*100, i*50, i*30))
+        img.save(os.path.join(folder, f"photo{i+1}.jpg"))
     print("Тестовые изображения созданы!")
 
-# =============================================================================
-# ЧАСТЬ 2: ИСПРАВЛЕНИЕ БАГОВ (Часть 1 РПО)
-# =============================================================================
+# Доли форматов в тестовом корпусе по умолчанию: расширение -> вес
+TEST_CORPUS_FORMATS = {'.jpg': 0.8, '.png': 0.2}
+
+def _test_corpus_task(index, seed, folder, size_range, extensions, weights, preset):
+    """
+    Одно изображение корпуса. Размер, формат и сдвиг цветов берутся из
+    генератора (seed корпуса, номер), поэтому файл не зависит от воркера.
+    """
+    rng = np.random.default_rng([seed, index])
+    (min_w, min_h), (max_w, max_h) = size_range
+    width = int(rng.integers(min_w, max_w + 1))
+    height = int(rng.integers(min_h, max_h + 1))
+    extension = extensions[rng.choice(len(extensions), p=weights)]
+    shift = rng.integers(0, 255, size=3)
+    path = os.path.join(folder, f"img_{index:06d}{extension}")
+    save_image(test_block_pattern(width, height, shift), path, preset)
+    return path
 
-def create_collage_from_folder_fixed(folder_path, output_path, rows=2, cols=2):
-    """ИСПРАВЛЕННАЯ ВЕРСИЯ: Создает коллаж из изображений в папке"""
-    images = []
+def generate_test_corpus(folder, count=1000, size_range=((640, 480), (1024, 768)),
+                         formats=None, seed=0, max_workers=4, backend='auto', preset='fastest'):
+    """
+    Корпус из count блочных тестовых изображений для нагрузочных прогонов.
+    size_range - минимальный и максимальный (ширина, высота), formats - доли
+    расширений (по умолчанию TEST_CORPUS_FORMATS). Файлы пишутся параллельно;
+    одинаковый seed дает одинаковый корпус при любом числе воркеров.
+    """
+    formats = formats or TEST_CORPUS_FORMATS
+    extensions = list(formats)
+    for extension in extensions:
+        output_format(f"img{extension}")
+    weights = np.array([formats[extension] for extension in extensions], dtype=float)
+    weights /= weights.sum()
     
-    # ИСПРАВЛЕНИЕ БАГА 1: Используем os.path.join для правильных путей
-    for file in os.listdir(folder_path):
-        if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-            img_path = os.path.join(folder_path, file)
-            try:
-                img = Image.open(img_path)
-                images.append(img)
-            except Exception as e:
-                print(f"Ошибка загрузки {file}: {e}")
+    print(f"Генерация тестового корпуса: {count} изображений (seed={seed})...")
+    os.makedirs(folder, exist_ok=True)
+    args = [(index, seed, folder, size_range, extensions, weights, preset)
+            for index in range(count)]
+    if resolve_backend(backend, count, max_workers) == 'process':
+        executor = get_process_pool(max_workers)
+        files = list(executor.map(_test_corpus_task, *zip(*args),
+                                  chunksize=choose_chunksize(count, max_workers)))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            files = list(executor.map(_test_corpus_task, *zip(*args)))
+    print(f"Тестовый корпус готов: {len(files)} файлов в {folder}")
+    return files
+
+# Расширения файлов, которые считаются изображениями во всех пакетных режимах
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def iter_image_files(folder, recursive=False):
+    """
+    Ленивый обход папки через os.scandir: отдает пути к изображениям по одному,
+    не собирая список целиком. При recursive=True заходит в подпапки.
+    """
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            stack.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield entry.path
+        except OSError as e:
+            print(f"Ошибка чтения папки {current}: {e}")
+
+def load_image_for_size(path, size, reducing_gap=2.0, fit=False):
+    """
+    Открывает изображение с уменьшением прямо при загрузке:
+    - JPEG декодируется через draft() в масштабе 1/2, 1/4 или 1/8
+    - остальные форматы уменьшаются reduce() на целый множитель
+    Результат не меньше целевого размера * reducing_gap, чтобы финальный
+    LANCZOS сохранил качество. Целевой размер - size (resize ровно в size)
+    или, при fit=True, size, вписанный с сохранением пропорций (как thumbnail).
+    reducing_gap=None отключает уменьшение.
+    """
+    img = Image.open(path)
+    if reducing_gap:
+        if fit:
+            scale = min(size[0] / img.width, size[1] / img.height, 1.0)
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        min_size = (int(size[0] * reducing_gap), int(size[1] * reducing_gap))
+        if img.format == 'JPEG':
+            img.draft('RGB', min_size)
+        img.load()
+        factor = min(img.width // max(min_size[0], 1), img.height // max(min_size[1], 1))
+        if factor >= 2:
+            img = img.reduce(factor)
+    else:
+        img.load()
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+def load_thumbnail(path, size, reducing_gap=2.0):
+    """Миниатюра, вписанная в size, с уменьшением при загрузке"""
+    img = load_image_for_size(path, size, reducing_gap, fit=True)
+    img.thumbnail(size, Image.Resampling.LANCZOS)
+    return img
+
+def load_resized(path, size, reducing_gap=2.0):
+    """Изображение ровно размера size, с уменьшением при загрузке"""
+    img = load_image_for_size(path, size, reducing_gap)
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+def psnr(reference, candidate):
+    """PSNR в дБ между двумя RGB изображениями одного размера"""
+    a = np.asarray(reference, dtype=np.float64)
+    b = np.asarray(candidate, dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * math.log10(255 ** 2 / mse)
+
+def benchmark_draft_loading(source_size=(6000, 4000), target_size=(400, 400),
+                            repeat=3, work_dir="./output/bench_draft"):
+    """
+    Сравнение полной загрузки + thumbnail с загрузкой в уменьшенном масштабе
+    на синтетическом 24MP JPEG: время и PSNR относительно полного пути
+    """
+    print("\n=== БЕНЧМАРК ЗАГРУЗКИ С УМЕНЬШЕНИЕМ ===")
     
-    if len(images) < rows * cols:
-        print(f"Недостаточно изображений: {len(images)} вместо {rows * cols}")
-        return
+    os.makedirs(work_dir, exist_ok=True)
+    source_path = os.path.join(work_dir, "source_24mp.jpg")
+    if not os.path.exists(source_path):
+        # Градиент с шумом, чтобы у JPEG были и плавные области, и детали
+        base = create_gradient(source_size, [(0.0, (30, 60, 200)), (0.5, (240, 200, 40)),
+                                             (1.0, (200, 40, 90))], kind='radial')
+        noise = Image.effect_noise(source_size, 40).convert('RGB')
+        Image.blend(base, noise, 0.25).save(source_path, quality=90)
+    
+    def full_path():
+        img = Image.open(source_path)
+        img_copy = img.copy()
+        img_copy.thumbnail(target_size, Image.Resampling.LANCZOS)
+        return img_copy
+    
+    def draft_path():
+        return load_thumbnail(source_path, target_size)
+    
+    timings = {}
+    outputs = {}
+    for name, func in (('full', full_path), ('draft', draft_path)):
+        best = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            outputs[name] = func()
+            best = min(best, time.perf_counter() - start_time)
+        timings[name] = best
+    
+    reference, candidate = outputs['full'], outputs['draft']
+    if candidate.size != reference.size:
+        candidate = candidate.resize(reference.size, Image.Resampling.LANCZOS)
+    quality = psnr(reference, candidate)
+    
+    print(f"Источник {source_size[0]}x{source_size[1]} -> {reference.size[0]}x{reference.size[1]}")
+    print(f"Полная загрузка: {timings['full']:.3f} с")
+    print(f"С уменьшением:   {timings['draft']:.3f} с")
+    print(f"Ускорение: {timings['full']/timings['draft']:.1f}x, PSNR: {quality:.1f} дБ")
+    return {
+        'full_seconds': timings['full'],
+        'draft_seconds': timings['draft'],
+        'speedup': timings['full'] / timings['draft'],
+        'psnr_db': quality
+    }
+
+# Кэш декодированных кадров: каталог общий для всех процессов, в кэше
+# пользователя (XDG_CACHE_HOME или ~/.cache), а не в папке результатов
+FRAME_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                               os.path.join(os.path.expanduser('~'), '.cache'),
+                               'image_frame_cache')
+FRAME_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Заголовок кадра: сигнатура, режим, ширина, высота; данные выровнены на 64 байта
+FRAME_MAGIC = b'PILFRM01'
+FRAME_HEADER = struct.Struct('<8s4sII')
+FRAME_HEADER_SIZE = 64
+# Режимы, которые Image.frombuffer отображает без копирования; RGB хранится как RGBX
+FRAME_MODES = {'RGB': 'RGBX', 'RGBX': 'RGBX', 'RGBA': 'RGBA', 'L': 'L'}
+
+class FrameCache:
+    """
+    Дисковый кэш декодированных кадров в сыром виде, читается через mmap:
+    Image.frombuffer отображает файл без копирования и без декодирования.
+    - ключ: абсолютный путь, размер и mtime исходника
+    - LRU по mtime файлов кадра (попадание обновляет mtime), общий размер
+      ограничен max_bytes
+    - запись атомарная (tmp + os.replace), поэтому каталог могут делить
+      несколько процессов
+    RGB кадры возвращаются в режиме RGBX (только для чтения); resize, rotate,
+    crop, convert('L') работают с ним напрямую, для RGB нужен convert('RGB').
+    """
     
+    def __init__(self, cache_dir=FRAME_CACHE_DIR, max_bytes=FRAME_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+    
+    def _frame_path(self, path):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.frame")
+    
+    @staticmethod
+    def _map(frame_path):
+        """
+        Отображает файл кадра в память; None если файла нет или он чужого
+        формата. Обрезанный файл (упавшая запись, чужой процесс) - тоже промах:
+        он удаляется и будет записан заново.
+        """
+        try:
+            with open(frame_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            magic, mode, width, height = FRAME_HEADER.unpack_from(mapped)
+            if magic != FRAME_MAGIC:
+                return None
+            mode = mode.rstrip(b'\0').decode('ascii')
+            data = memoryview(mapped)[FRAME_HEADER_SIZE:]
+            return Image.frombuffer(mode, (width, height), data, 'raw', mode, 0, 1)
+        except (struct.error, ValueError) as e:
+            print(f"Поврежденный кадр в кэше {os.path.basename(frame_path)}: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(frame_path)
+            return None
+    
+    def get(self, path):
+        """Кадр файла: из кэша без декодирования, при промахе - декодирует и кладет в кэш"""
+        frame_path = self._frame_path(path)
+        frame = self._map(frame_path)
+        if frame is not None:
+            self.hits += 1
+            with contextlib.suppress(OSError):
+                os.utime(frame_path)
+            return frame
+        
+        self.misses += 1
+        with Image.open(path) as img:
+            img = img.convert(FRAME_MODES.get(img.mode, 'RGBX'))
+        data = img.tobytes()
+        if FRAME_HEADER_SIZE + len(data) > self.max_bytes:
+            return img
+        
+        header = FRAME_HEADER.pack(FRAME_MAGIC, img.mode.encode('ascii'), img.width, img.height)
+        tmp_path = f"{frame_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header.ljust(FRAME_HEADER_SIZE, b'\0'))
+            f.write(data)
+        os.replace(tmp_path, frame_path)
+        self._evict()
+        return self._map(frame_path) or img
+    
+    def _entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.frame'):
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+    
+    def _evict(self):
+        """Удаляет самые давно использованные кадры, пока кэш больше max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, frame_path in entries:
+            if total <= self.max_bytes:
+                break
+            # Открытые отображения остаются валидными и после удаления файла
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(frame_path)
+            total -= size
+    
+    def stats(self):
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'frames': len(entries),
+                'bytes': sum(size for _, size, _ in entries), 'max_bytes': self.max_bytes}
+    
+    def clear(self):
+        for _, _, frame_path in self._entries():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(frame_path)
+
+# Кэш кадров процесса (создается при первом обращении)
+_FRAME_CACHE = None
+
+def get_frame_cache():
+    """FrameCache по умолчанию для текущего процесса"""
+    global _FRAME_CACHE
+    if _FRAME_CACHE is None:
+        _FRAME_CACHE = FrameCache()
+    return _FRAME_CACHE
+
+def benchmark_frame_cache(source_size=(4000, 3000), repeat=3, work_dir="./output/bench_frames"):
+    """
+    Сессия из нескольких операций над одним JPEG: каждая операция
+    декодирует файл заново против чтения кадра из FrameCache
+    """
+    print("\n=== БЕНЧМАРК КЭША КАДРОВ ===")
+    
+    os.makedirs(work_dir, exist_ok=True)
+    source_path = os.path.join(work_dir, "source.jpg")
+    if not os.path.exists(source_path):
+        noise = Image.merge('RGB', [Image.effect_noise(source_size, 30 + 10 * i) for i in range(3)])
+        noise.save(source_path, quality=90)
+    
+    operations = [
+        lambda img: img.resize((400, 300), Image.Resampling.LANCZOS),
+        lambda img: img.rotate(45, expand=True),
+        lambda img: img.convert('L'),
+        lambda img: img.crop((100, 100, 400, 400)).load(),
+        lambda img: analyze_image(img, proxy_size=128)
+    ]
+    
+    def decode_each_time():
+        for operation in operations:
+            with Image.open(source_path) as img:
+                operation(img)
+    
+    cache = FrameCache(os.path.join(work_dir, "cache"))
+    cache.clear()
+    
+    def cached():
+        for operation in operations:
+            operation(cache.get(source_path))
+    
+    timings = {}
+    for name, func in (('decode', decode_each_time), ('frame_cache', cached)):
+        best = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start_time)
+        timings[name] = best
+    
+    print(f"{len(operations)} операций над {source_size[0]}x{source_size[1]} JPEG")
+    print(f"Декодирование каждый раз: {timings['decode']:.3f} с")
+    print(f"Кэш кадров:               {timings['frame_cache']:.3f} с "
+          f"({timings['decode']/timings['frame_cache']:.1f}x)")
+    return timings
+
+# =============================================================================
+# ЧАСТЬ 2: ИСПРАВЛЕНИЕ БАГОВ (Часть 1 РПО)
+# =============================================================================
+
+def create_collage_from_folder_fixed(folder_path, output_path, rows=2, cols=2, dedupe=False,
+                                     dedupe_distance=None):
+    """
+    ИСПРАВЛЕННАЯ ВЕРСИЯ: Создает коллаж из изображений в папке.
+    Файлы открываются по одному: в памяти одновременно только текущая миниатюра.
+    dedupe=True: почти-дубликаты уже вклеенных миниатюр (dHash по самой
+    миниатюре) пропускаются.
+    """
     # ИСПРАВЛЕНИЕ БАГА 2: Приводим все к одному размеру вместо предположения
     thumbnail_size = (200, 200)
     
@@ -103,24 +694,289 @@ def create_collage_from_folder_fixed(folder_path, output_path, rows=2, cols=2):
     collage_height = rows * thumbnail_size[1]
     collage = Image.new('RGB', (collage_width, collage_height), 'white')
     
-    for i in range(rows):
-        for j in range(cols):
-            index = i * cols + j
-            if index < len(images):
-                # Ресайзим изображение
-                img_copy = images[index].copy()
-                img_copy.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
-                
-                # ИСПРАВЛЕНИЕ БАГА 3: Правильные координаты
-                x_offset = j * thumbnail_size[0]
-                y_offset = i * thumbnail_size[1]
-                collage.paste(img_copy, (x_offset, y_offset))
-    
-    collage.save(output_path)
+    # ИСПРАВЛЕНИЕ БАГА 1: Пути собирает iter_image_files через os.path.join
+    placed = 0
+    placed_hashes = MultiIndexHash(dedupe_distance or DEDUPE_MAX_DISTANCE) if dedupe else None
+    for img_path in iter_image_files(folder_path):
+        if placed == rows * cols:
+            break
+        try:
+            # Ресайзим изображение (JPEG декодируется сразу в уменьшенном масштабе)
+            img = load_thumbnail(img_path, thumbnail_size)
+            
+            if placed_hashes is not None:
+                value = dhash(img)
+                if placed_hashes.find(value):
+                    print(f"Почти-дубликат пропущен: {os.path.basename(img_path)}")
+                    continue
+                placed_hashes.add(value, img_path)
+            
+            # ИСПРАВЛЕНИЕ БАГА 3: Правильные координаты
+            x_offset = (placed % cols) * thumbnail_size[0]
+            y_offset = (placed // cols) * thumbnail_size[1]
+            collage.paste(img, (x_offset, y_offset))
+            placed += 1
+        except Exception as e:
+            print(f"Ошибка загрузки {os.path.basename(img_path)}: {e}")
+    
+    if placed < rows * cols:
+        print(f"Недостаточно изображений: {placed} вместо {rows * cols}")
+        return
+    
+    save_image(collage, output_path, preset='balanced')
     print(f"Коллаж сохранен: {output_path}")
 
-def create_smart_gradient_fixed(size=(400, 400), start_color=(255,0,0), end_color=(0,0,255)):
-    """ИСПРАВЛЕННАЯ ВЕРСИЯ: Создает умный градиент"""
+# Раскладки движка коллажей
+COLLAGE_LAYOUTS = ('grid', 'justified', 'masonry')
+
+def _image_size(path):
+    """Путь и размер по заголовку файла (без декодирования); None для нечитаемых файлов"""
+    try:
+        with Image.open(path) as img:
+            return path, img.size
+    except Exception as e:
+        print(f"Ошибка чтения {os.path.basename(path)}: {e}")
+        return path, None
+
+def _paginate_rows(rows, page_width, spacing, page_height):
+    """Раскладывает ряды [(высота, [(path, x, dy, w, h)])] по страницам сверху вниз"""
+    pages = []
+    cells = []
+    y = 0
+    for row_height, items in rows:
+        if page_height and cells and y + row_height > page_height:
+            pages.append((page_width, y - spacing, cells))
+            cells, y = [], 0
+        cells.extend((path, (x, y + dy, w, h)) for path, x, dy, w, h in items)
+        y += row_height + spacing
+    if cells:
+        pages.append((page_width, y - spacing, cells))
+    return pages
+
+def layout_collage(sizes, layout='grid', width=1600, cell_size=(200, 200), row_height=200,
+                   columns=6, spacing=4, page_height=None):
+    """
+    Раскладка коллажа только по размерам, без пикселей. sizes - [(path, (w, h))].
+    - grid: ячейки cell_size, миниатюра вписана в ячейку по центру
+    - justified: ряды высотой около row_height, растянутые на ширину width
+      (последний ряд не растягивается)
+    - masonry: columns колонок одной ширины, картинка идет в самую короткую
+    page_height: новая страница, когда ряд или картинка не помещается.
+    Возвращает страницы [(ширина, высота, [(path, (x, y, w, h)), ...]), ...].
+    """
+    if layout == 'grid':
+        cell_w, cell_h = cell_size
+        cols = max(1, (width + spacing) // (cell_w + spacing))
+        rows = []
+        for start in range(0, len(sizes), cols):
+            items = []
+            for col, (path, (w, h)) in enumerate(sizes[start:start + cols]):
+                scale = min(cell_w / w, cell_h / h)
+                tw, th = max(1, round(w * scale)), max(1, round(h * scale))
+                items.append((path, col * (cell_w + spacing) + (cell_w - tw) // 2,
+                              (cell_h - th) // 2, tw, th))
+            rows.append((cell_h, items))
+        return _paginate_rows(rows, cols * (cell_w + spacing) - spacing, spacing, page_height)
+    
+    if layout == 'justified':
+        rows = []
+        row = []
+        row_width = 0.0
+        for path, (w, h) in sizes:
+            row.append((path, w * row_height / h))
+            row_width += w * row_height / h
+            if row_width + spacing * (len(row) - 1) < width:
+                continue
+            # Ряд набран: растягиваем до ширины, последняя картинка добирает округление
+            factor = (width - spacing * (len(row) - 1)) / row_width
+            height = max(1, round(row_height * factor))
+            items = []
+            x = 0
+            for index, (item_path, scaled_w) in enumerate(row):
+                w_item = width - x if index == len(row) - 1 else max(1, round(scaled_w * factor))
+                items.append((item_path, x, 0, w_item, height))
+                x += w_item + spacing
+            rows.append((height, items))
+            row, row_width = [], 0.0
+        if row:
+            items = []
+            x = 0
+            for item_path, scaled_w in row:
+                items.append((item_path, x, 0, max(1, round(scaled_w)), row_height))
+                x += max(1, round(scaled_w)) + spacing
+            rows.append((row_height, items))
+        return _paginate_rows(rows, width, spacing, page_height)
+    
+    if layout == 'masonry':
+        column_w = max(1, (width - spacing * (columns - 1)) // columns)
+        page_width = columns * column_w + spacing * (columns - 1)
+        pages = []
+        cells = []
+        heights = [0] * columns
+        for path, (w, h) in sizes:
+            th = max(1, round(h * column_w / w))
+            col = heights.index(min(heights))
+            if page_height and heights[col] and heights[col] + th > page_height:
+                pages.append((page_width, max(heights) - spacing, cells))
+                cells, heights = [], [0] * columns
+                col = 0
+            cells.append((path, (col * (column_w + spacing), heights[col], column_w, th)))
+            heights[col] += th + spacing
+        if cells:
+            pages.append((page_width, max(heights) - spacing, cells))
+        return pages
+    
+    raise ValueError(f"Неизвестная раскладка коллажа: {layout} (доступны {COLLAGE_LAYOUTS})")
+
+def _collage_cell(path, box):
+    """Миниатюра ровно под ячейку box (уменьшение при загрузке); None при ошибке"""
+    try:
+        return box, load_resized(path, box[2:])
+    except Exception as e:
+        print(f"Ошибка загрузки {os.path.basename(path)}: {e}")
+        return box, None
+
+@contextlib.contextmanager
+def _collage_executor(backend, file_count, max_workers):
+    """Пул для миниатюр: прогретый пул процессов или временный пул потоков"""
+    if resolve_backend(backend, file_count, max_workers) == 'process':
+        yield get_process_pool(max_workers)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            yield executor
+
+def _collage_sizes(paths, executor, max_workers):
+    """Размеры исходников (только заголовки), параллельно; нечитаемые пропускаются"""
+    chunksize = choose_chunksize(len(paths), max_workers)
+    return [(path, size) for path, size in executor.map(_image_size, paths, chunksize=chunksize)
+            if size is not None]
+
+def create_collage(folder_path, output_path, layout='grid', width=1600, cell_size=(200, 200),
+                   row_height=200, columns=6, spacing=4, background='white', page_height=None,
+                   max_workers=4, backend='auto', recursive=False, limit=None, preset='balanced',
+                   dedupe=False, hash_index_path=None, dedupe_distance=None):
+    """
+    Движок коллажей: раскладка по заголовкам файлов, миниатюры строятся
+    параллельно и вклеиваются в холст по мере готовности - в памяти только
+    холст страницы и не больше max_workers * 4 миниатюр.
+    Контактные листы на тысячи изображений: page_height разбивает коллаж на
+    страницы output_001.jpg, output_002.jpg, ...
+    dedupe=True: почти-дубликаты по dHash (индекс hash_index_path) не попадают
+    в коллаж.
+    Возвращает список записанных файлов.
+    """
+    print(f"Коллаж ({layout}) из {folder_path}...")
+    written = []
+    paths = list(itertools.islice(iter_image_files(folder_path, recursive), limit))
+    with _collage_executor(backend, len(paths), max_workers) as executor:
+        if dedupe:
+            paths, _ = dedupe_paths(paths, hash_index_path, dedupe_distance or DEDUPE_MAX_DISTANCE,
+                                    max_workers, executor=executor)
+        sizes = _collage_sizes(paths, executor, max_workers)
+        if not sizes:
+            print("Нет изображений для коллажа")
+            return written
+        pages = layout_collage(sizes, layout, width, cell_size, row_height, columns,
+                               spacing, page_height)
+        stem, ext = os.path.splitext(output_path)
+        for index, (page_width, page_h, cells) in enumerate(pages):
+            canvas = Image.new('RGB', (page_width, page_h), background)
+            for (x, y, _, _), thumb in bounded_map(executor, _collage_cell, cells,
+                                                   max_workers * 4):
+                if thumb is not None:
+                    canvas.paste(thumb, (x, y))
+            page_path = output_path if len(pages) == 1 else f"{stem}_{index + 1:03d}{ext}"
+            save_image(canvas, page_path, preset)
+            written.append(page_path)
+    print(f"Коллаж сохранен: {len(sizes)} изображений, страниц: {len(written)}")
+    return written
+
+def _deepzoom_parent_tile(child_dir, level_dir, column, row, tile_size, child_size, tile_format):
+    """Тайл уровня собирается из (до) четырех тайлов уровня выше с уменьшением в 2 раза"""
+    left, top = 2 * column * tile_size, 2 * row * tile_size
+    width = min(left + 2 * tile_size, child_size[0]) - left
+    height = min(top + 2 * tile_size, child_size[1]) - top
+    assembled = Image.new('RGB', (width, height))
+    for dx in (0, 1):
+        for dy in (0, 1):
+            child = os.path.join(child_dir, f"{2 * column + dx}_{2 * row + dy}.{tile_format}")
+            if os.path.exists(child):
+                with Image.open(child) as tile:
+                    assembled.paste(tile, (dx * tile_size, dy * tile_size))
+    tile = assembled.resize(((width + 1) // 2, (height + 1) // 2), Image.Resampling.BOX)
+    save_image(tile, os.path.join(level_dir, f"{column}_{row}.{tile_format}"))
+
+def create_deepzoom(folder_path, output_dir, name='collage', layout='justified', width=8192,
+                    cell_size=(200, 200), row_height=200, columns=24, spacing=4,
+                    background='white', tile_size=254, tile_format='jpg', max_workers=4,
+                    backend='auto', recursive=False, limit=None):
+    """
+    Коллаж как пирамида тайлов DeepZoom (name.dzi + name_files/<уровень>/<x>_<y>.jpg).
+    Верхний уровень рисуется полосами высотой tile_size: в памяти полоса и
+    миниатюры, которые ее пересекают. Нижние уровни собираются из тайлов
+    уровня выше параллельно. Overlap = 0.
+    """
+    print(f"DeepZoom коллаж ({layout}) из {folder_path}...")
+    paths = list(itertools.islice(iter_image_files(folder_path, recursive), limit))
+    with _collage_executor(backend, len(paths), max_workers) as executor:
+        sizes = _collage_sizes(paths, executor, max_workers)
+        if not sizes:
+            print("Нет изображений для коллажа")
+            return None
+        (full_w, full_h, cells), = layout_collage(sizes, layout, width, cell_size, row_height,
+                                                  columns, spacing)
+        cells.sort(key=lambda cell: cell[1][1])
+        
+        files_dir = os.path.join(output_dir, f"{name}_files")
+        max_level = max(0, math.ceil(math.log2(max(full_w, full_h))))
+        level_dir = os.path.join(files_dir, str(max_level))
+        os.makedirs(level_dir, exist_ok=True)
+        
+        # Верхний уровень полосами
+        next_cell = 0
+        active = []
+        for row in range(math.ceil(full_h / tile_size)):
+            band_top = row * tile_size
+            band_bottom = min(full_h, band_top + tile_size)
+            start = next_cell
+            while next_cell < len(cells) and cells[next_cell][1][1] < band_bottom:
+                next_cell += 1
+            active += [cell for cell in bounded_map(executor, _collage_cell,
+                                                    cells[start:next_cell], max_workers * 4)
+                       if cell[1] is not None]
+            band = Image.new('RGB', (full_w, band_bottom - band_top), background)
+            for (x, y, _, _), thumb in active:
+                band.paste(thumb, (x, y - band_top))
+            active = [cell for cell in active if cell[0][1] + cell[0][3] > band_bottom]
+            for column in range(math.ceil(full_w / tile_size)):
+                tile = band.crop((column * tile_size, 0,
+                                  min(full_w, (column + 1) * tile_size), band.height))
+                save_image(tile, os.path.join(level_dir, f"{column}_{row}.{tile_format}"))
+        
+        # Нижние уровни из тайлов уровня выше
+        level_size = (full_w, full_h)
+        for level in range(max_level - 1, -1, -1):
+            child_dir, child_size = level_dir, level_size
+            level_size = ((child_size[0] + 1) // 2, (child_size[1] + 1) // 2)
+            level_dir = os.path.join(files_dir, str(level))
+            os.makedirs(level_dir, exist_ok=True)
+            jobs = [(child_dir, level_dir, column, row, tile_size, child_size, tile_format)
+                    for row in range(math.ceil(level_size[1] / tile_size))
+                    for column in range(math.ceil(level_size[0] / tile_size))]
+            for future in [executor.submit(_deepzoom_parent_tile, *job) for job in jobs]:
+                future.result()
+    
+    dzi_path = os.path.join(output_dir, f"{name}.dzi")
+    with open(dzi_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                f'TileSize="{tile_size}" Overlap="0" Format="{tile_format}">'
+                f'<Size Width="{full_w}" Height="{full_h}"/></Image>\n')
+    print(f"DeepZoom сохранен: {dzi_path} ({full_w}x{full_h}, уровней {max_level + 1})")
+    return dzi_path
+
+def create_smart_gradient_slow(size=(400, 400), start_color=(255,0,0), end_color=(0,0,255)):
+    """Попиксельная версия градиента через draw.point (эталон для сравнения)"""
     img = Image.new('RGB', size, color=start_color)
     draw = ImageDraw.Draw(img)
     
@@ -144,6 +1000,123 @@ def create_smart_gradient_fixed(size=(400, 400), start_color=(255,0,0), end_colo
     
     return img
 
+def _gradient_axes(size):
+    """Нормированные координаты X (строка) и Y (столбец) для broadcasting"""
+    width, height = size
+    if width > 1:
+        ratio_x = np.arange(width, dtype=np.float64) / (width - 1)
+    else:
+        ratio_x = np.zeros(width, dtype=np.float64)
+    if height > 1:
+        ratio_y = np.arange(height, dtype=np.float64) / (height - 1)
+    else:
+        ratio_y = np.zeros(height, dtype=np.float64)
+    return ratio_x[np.newaxis, :], ratio_y[:, np.newaxis]
+
+def _to_channel(values, size):
+    """Отбрасывает дробную часть как int() и ограничивает канал 0..255"""
+    channel = np.clip(np.trunc(values), 0, 255).astype(np.uint8)
+    return np.broadcast_to(channel, (size[1], size[0]))
+
+def _merge_channels(channels, size):
+    """Собирает RGB изображение из трех массивов каналов"""
+    pixels = np.empty((size[1], size[0], 3), dtype=np.uint8)
+    for index, channel in enumerate(channels):
+        pixels[:, :, index] = channel
+    return Image.fromarray(pixels)
+
+def create_smart_gradient_fixed(size=(400, 400), start_color=(255,0,0), end_color=(0,0,255)):
+    """
+    ИСПРАВЛЕННАЯ ВЕРСИЯ: Создает умный градиент.
+    Каналы считаются целыми массивами, результат побайтно совпадает
+    с create_smart_gradient_slow.
+    """
+    ratio_x, ratio_y = _gradient_axes(size)
+    ratio_xy = (ratio_x + ratio_y) / 2
+    
+    # Та же формула и тот же порядок операций, что и в попиксельной версии
+    r = start_color[0] * (1 - ratio_x) + end_color[0] * ratio_x
+    g = start_color[1] * (1 - ratio_y) + end_color[1] * ratio_y
+    b = start_color[2] * (1 - ratio_xy) + end_color[2] * ratio_xy
+    
+    return _merge_channels([_to_channel(c, size) for c in (r, g, b)], size)
+
+def create_gradient(size=(400, 400), stops=((0.0, (255, 0, 0)), (1.0, (0, 0, 255))),
+                    kind='linear', angle=0.0, center=(0.5, 0.5)):
+    """
+    Векторный генератор градиентов:
+    - linear: вдоль направления angle (в градусах)
+    - radial: от центра center к самому дальнему углу
+    - angular: по кругу вокруг center, начиная с угла angle
+    stops - список (позиция 0..1, цвет RGB), опорных цветов может быть сколько угодно
+    """
+    if not stops:
+        raise ValueError("Нужен хотя бы один опорный цвет")
+    
+    stops = sorted(stops, key=lambda stop: stop[0])
+    positions = [float(pos) for pos, _ in stops]
+    
+    width, height = size
+    xs = np.arange(width, dtype=np.float64)[np.newaxis, :]
+    ys = np.arange(height, dtype=np.float64)[:, np.newaxis]
+    cx = center[0] * (width - 1)
+    cy = center[1] * (height - 1)
+    
+    if kind == 'linear':
+        rad = math.radians(angle)
+        projection = xs * math.cos(rad) + ys * math.sin(rad)
+        corners = [x * math.cos(rad) + y * math.sin(rad)
+                   for x in (0, width - 1) for y in (0, height - 1)]
+        low, high = min(corners), max(corners)
+        t = (projection - low) / (high - low) if high > low else projection * 0
+    elif kind == 'radial':
+        distance = np.hypot(xs - cx, ys - cy)
+        max_distance = max(math.hypot(x - cx, y - cy)
+                           for x in (0, width - 1) for y in (0, height - 1))
+        t = distance / max_distance if max_distance > 0 else distance
+    elif kind == 'angular':
+        theta = np.arctan2(ys - cy, xs - cx) - math.radians(angle)
+        t = np.mod(theta, 2 * math.pi) / (2 * math.pi)
+    else:
+        raise ValueError(f"Неизвестный тип градиента: {kind}")
+    
+    channels = []
+    for c in range(3):
+        values = np.interp(t, positions, [float(color[c]) for _, color in stops])
+        channels.append(_to_channel(values, size))
+    return _merge_channels(channels, size)
+
+def benchmark_gradients(sizes=((400, 400), (1920, 1080), (7680, 4320)), repeat=3):
+    """Сравнение попиксельного и векторного градиента на разных разрешениях"""
+    print("\n=== БЕНЧМАРК ГРАДИЕНТОВ ===")
+    
+    results = []
+    for size in sizes:
+        start_time = time.perf_counter()
+        slow_img = create_smart_gradient_slow(size)
+        slow_time = time.perf_counter() - start_time
+        
+        # Для быстрой версии берем лучшее из нескольких запусков
+        fast_time = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            fast_img = create_smart_gradient_fixed(size)
+            fast_time = min(fast_time, time.perf_counter() - start_time)
+        
+        identical = slow_img.tobytes() == fast_img.tobytes()
+        results.append({
+            'size': size,
+            'slow_seconds': slow_time,
+            'fast_seconds': fast_time,
+            'speedup': slow_time / fast_time,
+            'identical': identical
+        })
+        print(f"{size[0]}x{size[1]}: попиксельно {slow_time:.3f} с, "
+              f"векторно {fast_time:.4f} с, ускорение {slow_time/fast_time:.0f}x, "
+              f"совпадение: {'да' if identical else 'НЕТ'}")
+    
+    return results
+
 def debug_fixed_functions():
     """Демонстрация исправленных функций"""
     print("\n=== ИСПРАВЛЕНИЕ БАГОВ ===")
@@ -157,6 +1130,7 @@ def debug_fixed_functions():
     
     # Создаем коллаж
     create_collage_from_folder_fixed("./input", "./output/collage_fixed.jpg", 2, 2)
+    create_collage("./input", "./output/collage_justified.jpg", layout='justified', width=800)
     
     print("Исправленные функции протестированы!")
 
@@ -164,222 +1138,2218 @@ def debug_fixed_functions():
 # ЧАСТЬ 3: АНАЛИЗ И УМНАЯ ОБРАБОТКА (Часть 2 РПО)
 # =============================================================================
 
-def analyze_dominant_color(image_path):
+# Минимальная сторона прокси для анализа
+ANALYSIS_PROXY_MIN_SIDE = 64
+# Расхождение среднего прокси и полного кадра (уровней, после округления вниз).
+# reduce() с весами неполных крайних блоков дает точное среднее до округления
+# пикселей прокси (<= 0.5), поэтому после int() - не больше 1 уровня.
+# JPEG, уменьшенный при декодировании (draft), дополнительно расходится из-за
+# DCT-масштабирования неполных блоков 8x8: до 2 уровней на синтетических
+# кадрах с контрастными краями (80 случайных размеров 300-2500, качество 92).
+ANALYSIS_PROXY_ERROR = 1
+ANALYSIS_DRAFT_ERROR = 2
+
+# Кэш палитр: ключ - хеш содержимого и параметры, значение - палитра
+PALETTE_CACHE_SIZE = 4096
+_PALETTE_CACHE = OrderedDict()
+
+def _cached_palette(key, compute):
+    """LRU-кэш палитр по ключу с хешем содержимого"""
+    palette = _PALETTE_CACHE.get(key)
+    if palette is not None:
+        _PALETTE_CACHE.move_to_end(key)
+        return palette
+    palette = compute()
+    _PALETTE_CACHE[key] = palette
+    if len(_PALETTE_CACHE) > PALETTE_CACHE_SIZE:
+        _PALETTE_CACHE.popitem(last=False)
+    return palette
+
+def _quantize_sample(sample, k):
+    """Квантует выборку median cut и возвращает [((r, g, b), доля), ...] по убыванию доли"""
+    quantized = sample.quantize(colors=k, method=Image.Quantize.MEDIANCUT)
+    flat_palette = quantized.getpalette()
+    total = sample.width * sample.height
+    colors = sorted(quantized.getcolors(k), reverse=True)
+    return [(tuple(flat_palette[index * 3:index * 3 + 3]), count / total)
+            for count, index in colors]
+
+def extract_palette(image, k=5, sample_size=32):
+    """
+    Палитра из k цветовых кластеров изображения с их долями.
+    Пиксели прореживаются до sample_size x sample_size (NEAREST не смешивает
+    цвета), затем квантуются median cut. Путь к файлу кэшируется по хешу
+    содержимого, изображение - по хешу выборки.
+    Быстрый FASTOCTREE не используется: при k < 16 он сваливает большую
+    часть пикселей в один кластер.
+    """
+    if not isinstance(image, Image.Image):
+        key = (file_content_hash(image), k, sample_size)
+        return _cached_palette(key, lambda: extract_palette(
+            load_image_for_size(image, (sample_size, sample_size), fit=True), k, sample_size))
+    
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    sample = image
+    if image.width > sample_size or image.height > sample_size:
+        scale = sample_size / max(image.width, image.height)
+        sample = image.resize((max(1, round(image.width * scale)),
+                               max(1, round(image.height * scale))),
+                              Image.Resampling.NEAREST)
+    key = (hashlib.blake2b(sample.tobytes(), digest_size=16).hexdigest(), k, sample_size)
+    return _cached_palette(key, lambda: _quantize_sample(sample, k))
+
+def benchmark_palette(folder="./output/bench_palette", count=200, thumbnail_size=128,
+                      sample_sizes=(32, 64)):
+    """Скорость извлечения палитры на миниатюрах синтетического корпуса"""
+    print("\n=== БЕНЧМАРК ПАЛИТРЫ ===")
+    
+    if not os.path.isdir(folder) or len(list(iter_image_files(folder))) < count:
+        generate_test_corpus(folder, count, size_range=((800, 600), (800, 600)),
+                             formats={'.jpg': 1.0})
+    thumbnails = [load_thumbnail(path, (thumbnail_size, thumbnail_size))
+                  for path in list(iter_image_files(folder))[:count]]
+    
+    results = {}
+    for sample_size in sample_sizes:
+        _PALETTE_CACHE.clear()
+        start_time = time.perf_counter()
+        for thumb in thumbnails:
+            extract_palette(thumb, sample_size=sample_size)
+        cold = time.perf_counter() - start_time
+        
+        # Повторный проход - попадания в кэш
+        start_time = time.perf_counter()
+        for thumb in thumbnails:
+            extract_palette(thumb, sample_size=sample_size)
+        warm = time.perf_counter() - start_time
+        
+        results[sample_size] = {'cold_per_second': len(thumbnails) / cold,
+                                'cached_per_second': len(thumbnails) / warm}
+        print(f"Выборка {sample_size}px: {len(thumbnails)/cold:.0f} изобр/с, "
+              f"из кэша {len(thumbnails)/warm:.0f} изобр/с")
+    return results
+
+def _reduce_block_weights(length, factor):
+    """Сколько исходных пикселей по оси попадает в каждый пиксель img.reduce(factor)"""
+    weights = np.full(-(-length // factor), factor, dtype=np.float64)
+    weights[-1] = length - factor * (len(weights) - 1)
+    return weights
+
+def load_analysis_image(path, proxy_size):
+    """
+    Кадр для analyze_image(img, proxy_size): JPEG декодируется через draft
+    не меньше proxy_size (DCT-масштабирование усредняет блоки 8x8), остальные
+    форматы - целиком; дальше уменьшает и усредняет сам analyze_image.
+    """
+    side = max(proxy_size, ANALYSIS_PROXY_MIN_SIDE)
+    img = Image.open(path)
+    if img.format == 'JPEG':
+        img.draft('RGB', (side, side))
+    img.load()
+    return img
+
+def analyze_image(img, proxy_size=None):
+    """
+    Анализирует уже декодированное изображение за один проход по гистограмме:
+    доминирующий цвет и палитра, средний цвет, цветовая температура и яркость.
+    proxy_size: анализировать уменьшенную копию (box-усреднение reduce()).
+    Среднее прокси отличается от полного не больше чем на ANALYSIS_PROXY_ERROR
+    уровня (ANALYSIS_DRAFT_ERROR, если JPEG уже уменьшен через draft);
+    палитра и так строится по выборке пикселей.
+    """
+    # Конвертируем в RGB если нужно
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    weights = None
+    if proxy_size:
+        proxy_size = max(proxy_size, ANALYSIS_PROXY_MIN_SIDE)
+        factor = min(img.width, img.height) // proxy_size
+        if factor >= 2:
+            # Крайние блоки reduce неполные, если размер не делится на factor:
+            # вес пикселя прокси - число исходных пикселей его блока
+            weights = np.outer(_reduce_block_weights(img.height, factor),
+                               _reduce_block_weights(img.width, factor))
+            img = img.reduce(factor)
+    
+    # Доминирующий цвет - самый весомый цвет палитры, а не мода каждого
+    # канала по отдельности (та давала цвета, которых нет в изображении)
+    palette = extract_palette(img)
+    
+    if weights is None:
+        # Средний цвет по гистограмме (как ImageStat, но без второго прохода)
+        hist = img.histogram()
+        pixel_count = img.width * img.height
+        mean_color = [
+            int(sum(value * count for value, count in enumerate(hist[offset:offset + 256])) / pixel_count)
+            for offset in (0, 256, 512)
+        ]
+    else:
+        weighted = np.tensordot(weights, np.asarray(img, dtype=np.float64), axes=([0, 1], [0, 1]))
+        mean_color = [int(value) for value in weighted / weights.sum()]
+    
+    # Определяем цветовую температуру
+    warmth = (mean_color[0] - mean_color[2]) / 255.0
+    if warmth > 0.1:
+        color_temp = "теплое"
+    elif warmth < -0.1:
+        color_temp = "холодное"
+    else:
+        color_temp = "нейтральное"
+    
+    # Определяем яркость
+    brightness = sum(mean_color) / 3 / 255.0
+    if brightness < 0.3:
+        brightness_level = "темное"
+    elif brightness < 0.7:
+        brightness_level = "среднее"
+    else:
+        brightness_level = "светлое"
+    
+    return {
+        'dominant_rgb': palette[0][0],
+        'palette': palette,
+        'mean_rgb': tuple(mean_color),
+        'color_temperature': color_temp,
+        'brightness': brightness_level,
+        'warmth_index': warmth
+    }
+
+def analyze_dominant_color(image_path, proxy_size=None):
     """
     Анализирует изображение и определяет:
     - Доминирующий цвет (RGB)
     - Цветовую температуру (теплое/холодное/нейтральное)
     - Яркость изображения (темное/среднее/светлое)
+    Принимает путь или уже открытое изображение. С proxy_size JPEG
+    декодируется сразу в уменьшенном масштабе.
     """
+    if isinstance(image_path, Image.Image):
+        return analyze_image(image_path, proxy_size)
+    if proxy_size:
+        return analyze_image(load_analysis_image(image_path, proxy_size), proxy_size)
     with Image.open(image_path) as img:
-        # Конвертируем в RGB если нужно
+        return analyze_image(img)
+
+# Сторона квадратного прокси для классификатора (JPEG декодируется через draft)
+CLASSIFIER_PROXY_SIZE = 64
+# Перепад яркости соседних пикселей прокси, начиная с которого пиксель - край
+CLASSIFIER_EDGE_THRESHOLD = 40
+# Сколько прокси классифицируется одним векторным проходом
+CLASSIFIER_CHUNK = 4096
+# Классы умной обработки; у каждого своя цепочка в SMART_PIPELINES
+IMAGE_CLASSES = ('text', 'portrait', 'landscape', 'night', 'unknown')
+
+def classifier_proxy(img, size=CLASSIFIER_PROXY_SIZE):
+    """Прокси size x size уже декодированного изображения как массив uint8 (H, W, 3)"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    factor = min(img.width, img.height) // (size * 2)
+    if factor >= 2:
+        img = img.reduce(factor)
+    return np.asarray(img.resize((size, size), Image.Resampling.BILINEAR))
+
+def load_classifier_proxy(path, size=CLASSIFIER_PROXY_SIZE):
+    """Прокси файла с уменьшением при загрузке; None, если файл не читается"""
+    try:
+        return classifier_proxy(load_image_for_size(path, (size, size)), size)
+    except Exception as e:
+        print(f"Ошибка загрузки {os.path.basename(path)}: {e}")
+        return None
+
+def classifier_features(proxies):
+    """
+    Признаки для пачки прокси (N, H, W, 3) одним векторным проходом:
+    средний цвет, доли темных и светлых пикселей гистограммы яркости,
+    средняя насыщенность и плотность краев (перепады яркости соседей).
+    """
+    proxies = np.asarray(proxies)
+    luma = proxies @ np.array(LUMA_WEIGHTS, dtype=np.float32)
+    channel_max = proxies.max(axis=3).astype(np.float32)
+    channel_min = proxies.min(axis=3)
+    gradient = (np.abs(np.diff(luma, axis=2))[:, :-1, :] +
+                np.abs(np.diff(luma, axis=1))[:, :, :-1])
+    return {
+        'mean_rgb': proxies.mean(axis=(1, 2)),
+        'dark': (luma < 64).mean(axis=(1, 2)),
+        'bright': (luma > 192).mean(axis=(1, 2)),
+        'saturation': ((channel_max - channel_min) / np.maximum(channel_max, 1)).mean(axis=(1, 2)),
+        'edges': (gradient > CLASSIFIER_EDGE_THRESHOLD).mean(axis=(1, 2))
+    }
+
+def classify_proxies(proxies):
+    """
+    Тип каждого изображения пачки (массив строк из IMAGE_CLASSES).
+    Правила портрета, пейзажа и ночного - прежние эвристики по среднему
+    цвету; текст - много резких краев на почти бесцветном двуцветном фоне.
+    """
+    features = classifier_features(proxies)
+    r, g, b = features['mean_rgb'].T
+    skin_tone_ratio = r / np.maximum(g, 1)
+    rules = [
+        (features['edges'] > 0.12) & (features['saturation'] < 0.15) &
+        (features['dark'] + features['bright'] > 0.6),
+        (skin_tone_ratio > 0.8) & (skin_tone_ratio < 1.4) & (r > 100) & (g > 70) & (b > 50),
+        (g > r) & (g > b) & (g > 100),
+        ((r + g + b) / 3 / 255.0 < 0.3) & (features['mean_rgb'].max(axis=1) -
+                                           features['mean_rgb'].min(axis=1) > 50)
+    ]
+    return np.select(rules, IMAGE_CLASSES[:-1], IMAGE_CLASSES[-1])
+
+def classify_image(img):
+    """Тип одного уже декодированного изображения"""
+    return str(classify_proxies(classifier_proxy(img)[np.newaxis])[0])
+
+def smart_processing(image_path, output_path, tile_size=None, frame_cache=None,
+                     image_type=None):
+    """
+    Автоматически определяет тип изображения и применяет оптимальную обработку:
+    - ПОРТРЕТ: легкое размытие фона, коррекция кожи
+    - ПЕЙЗАЖ: усиление насыщенности, контраста  
+    - ТЕКСТ: повышение резкости, конвертация в ч/б
+    - НОЧНОЕ: шумоподавление, коррекция экспозиции
+    tile_size: обработка тайлами; по умолчанию включается сама для
+    изображений больше TILED_AUTO_PIXELS.
+    frame_cache: FrameCache - повторная обработка того же файла без декодирования.
+    image_type: класс, уже найденный классификатором (smart_batch_processor) -
+    тогда изображение не классифицируется повторно.
+    """
+    if frame_cache is not None:
+        source = contextlib.nullcontext(frame_cache.get(image_path).convert('RGB'))
+    else:
+        source = Image.open(image_path)
+    with source as img:
+        # Цепочки не меняют вход, поэтому копия не нужна
+        img_working = img
+        
+        # Классификация по маленькому прокси уже декодированного изображения
+        if image_type is None:
+            image_type = classify_image(img)
+        
+        # Применяем соответствующую обработку (цепочки в SMART_PIPELINES);
+        # большие изображения обрабатываются тайлами (без промежуточных полных
+        # копий; сам кадр и результат все равно целиком в памяти)
+        pipelines = smart_pipelines()
+        pipeline = pipelines.get(image_type, pipelines['unknown'])
+        if tile_size is None and img_working.width * img_working.height > TILED_AUTO_PIXELS:
+            tile_size = 1024
+        if tile_size:
+            img_working = apply_graph_tiled(img_working, pipeline, tile_size)
+        else:
+            img_working = pipeline.apply(img_working)
+        
+        save_image(img_working, output_path, preset='balanced')
+        print(f"Обработано как {image_type}: {output_path}")
+        return image_type
+
+def _smart_task(input_path, output_path, image_type):
+    """Умная обработка одного файла с заранее найденным классом"""
+    try:
+        smart_processing(input_path, output_path, image_type=image_type)
+        return {'file': os.path.basename(input_path), 'output': output_path, 'ok': True,
+                'error': None, 'image_type': image_type}
+    except Exception as e:
+        return {'file': os.path.basename(input_path), 'output': output_path, 'ok': False,
+                'error': str(e), 'image_type': image_type}
+
+def classify_files(paths, executor, max_workers=4, proxy_size=CLASSIFIER_PROXY_SIZE):
+    """
+    Классы файлов: прокси декодируются параллельно, классификация идет
+    векторно пачками по CLASSIFIER_CHUNK. Нечитаемые файлы получают None.
+    """
+    classes = []
+    for start in range(0, len(paths), CLASSIFIER_CHUNK):
+        chunk = paths[start:start + CLASSIFIER_CHUNK]
+        proxies = list(executor.map(load_classifier_proxy, chunk, [proxy_size] * len(chunk),
+                                    chunksize=choose_chunksize(len(chunk), max_workers)))
+        readable = [i for i, proxy in enumerate(proxies) if proxy is not None]
+        chunk_classes = [None] * len(chunk)
+        if readable:
+            for i, image_type in zip(readable,
+                                     classify_proxies(np.stack([proxies[i] for i in readable]))):
+                chunk_classes[i] = str(image_type)
+        classes.extend(chunk_classes)
+    return classes
+
+def _smart_output_path(input_path, input_folder, output_folder):
+    """Выход повторяет структуру папок входа: <папка>/smart_<имя>"""
+    folder, filename = os.path.split(os.path.relpath(input_path, input_folder))
+    return os.path.join(output_folder, folder, f"smart_{filename}")
+
+def smart_batch_processor(input_folder, output_folder, max_workers=4, backend='auto',
+                          recursive=False, proxy_size=CLASSIFIER_PROXY_SIZE):
+    """
+    Умная обработка папки в две стадии:
+    1. классификация по крошечным прокси (векторно пачками);
+    2. обработка по классам - файлы одного класса идут подряд через одну
+       заранее скомпилированную цепочку SMART_PIPELINES.
+    Результаты повторяют структуру папок входа (важно при recursive=True).
+    Возвращает итоги по файлам, число файлов по классам и пропускную
+    способность каждой стадии (файлов в секунду).
+    """
+    print("Запуск умной пакетной обработки...")
+    os.makedirs(output_folder, exist_ok=True)
+    paths = list(iter_image_files(input_folder, recursive))
+    
+    if resolve_backend(backend, len(paths), max_workers) == 'process':
+        executor_context = contextlib.nullcontext(get_process_pool(max_workers))
+    else:
+        executor_context = ThreadPoolExecutor(max_workers=max_workers)
+    with executor_context as executor:
+        start_time = time.perf_counter()
+        classes = classify_files(paths, executor, max_workers, proxy_size)
+        classify_seconds = time.perf_counter() - start_time
+        
+        groups = {}
+        for path, image_type in zip(paths, classes):
+            if image_type is not None:
+                groups.setdefault(image_type, []).append(path)
+        
+        start_time = time.perf_counter()
+        results = []
+        for image_type in IMAGE_CLASSES:
+            group = groups.get(image_type, [])
+            outputs = [_smart_output_path(p, input_folder, output_folder) for p in group]
+            for folder in set(map(os.path.dirname, outputs)):
+                os.makedirs(folder, exist_ok=True)
+            results.extend(executor.map(_smart_task, group, outputs, [image_type] * len(group),
+                                        chunksize=choose_chunksize(len(group), max_workers)))
+        process_seconds = time.perf_counter() - start_time
+    
+    summary = {
+        'results': results,
+        'classes': {image_type: len(group) for image_type, group in groups.items()},
+        'classify_per_second': len(paths) / classify_seconds if classify_seconds else 0.0,
+        'process_per_second': len(results) / process_seconds if process_seconds else 0.0
+    }
+    success_count = sum(1 for r in results if r['ok'])
+    print(f"Умная обработка завершена: {success_count}/{len(paths)} файлов, классы: "
+          f"{summary['classes']}")
+    print(f"Классификация: {summary['classify_per_second']:.0f} файлов/с, "
+          f"обработка: {summary['process_per_second']:.0f} файлов/с")
+    return summary
+
+def benchmark_analysis(image_paths, repeat=3, proxy_size=128):
+    """
+    Анализ + подготовка к обработке: старый путь (два декодирования,
+    гистограмма и ImageStat) против одного декодирования и прокси
+    """
+    print("\n=== БЕНЧМАРК АНАЛИЗА ===")
+    
+    def double_decode(path):
+        with Image.open(path) as img:
+            img.load()
+            with Image.open(path) as again:
+                again = again.convert('RGB')
+                again.histogram()
+                ImageStat.Stat(again)
+    
+    def single_decode(path):
+        with Image.open(path) as img:
+            analyze_image(img)
+    
+    def proxy_decode(path):
+        analyze_dominant_color(path, proxy_size=proxy_size)
+    
+    results = {}
+    for name, func in (('double', double_decode), ('single', single_decode),
+                       ('proxy', proxy_decode)):
+        best = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            for path in image_paths:
+                func(path)
+            best = min(best, time.perf_counter() - start_time)
+        results[name] = best / max(len(image_paths), 1)
+    
+    errors = []
+    for path in image_paths:
+        full = analyze_dominant_color(path)['mean_rgb']
+        proxy = analyze_dominant_color(path, proxy_size=proxy_size)['mean_rgb']
+        errors.append(max(abs(a - b) for a, b in zip(full, proxy)))
+    results['proxy_mean_error'] = max(errors) if errors else 0
+    if results['proxy_mean_error'] > ANALYSIS_DRAFT_ERROR:
+        print(f"Внимание: ошибка среднего прокси больше ANALYSIS_DRAFT_ERROR ({ANALYSIS_DRAFT_ERROR})")
+    
+    print(f"Два декодирования: {results['double']*1000:.1f} мс/файл")
+    print(f"Одно декодирование: {results['single']*1000:.1f} мс/файл")
+    print(f"Прокси {proxy_size}px: {results['proxy']*1000:.1f} мс/файл, "
+          f"ошибка среднего до {results['proxy_mean_error']}")
+    return results
+
+def demo_smart_processing():
+    """Демонстрация умной обработки"""
+    print("\n=== УМНАЯ ОБРАБОТКА ===")
+    
+    # Анализ доминирующего цвета
+    for i in range(1, 4):
+        input_path = f"./input/photo{i}.jpg"
+        if os.path.exists(input_path):
+            analysis = analyze_dominant_color(input_path)
+            print(f"Анализ photo{i}.jpg: {analysis}")
+            
+            # Умная обработка
+            output_path = f"./output/photo{i}_smart.jpg"
+            image_type = smart_processing(input_path, output_path)
+            print(f"Тип изображения: {image_type}")
+
+# =============================================================================
+# ЧАСТЬ 4: ПАКЕТНАЯ ОБРАБОТКА И ОПТИМИЗАЦИЯ (Часть 3 РПО)
+# =============================================================================
+
+# Коэффициенты яркости (ITU-R 601-2), те же, что в Image.convert("L")
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+class FilterGraph:
+    """
+    Цепочка фильтров с компиляцией в минимальное число проходов:
+    - яркость, контраст и насыщенность сворачиваются в одну
+      цветовую матрицу 3x4, которая применяется за один convert()
+    - при fuse_kernels=True соседние свертки объединяются в одно ядро
+      (3x3 + 3x3 -> 5x5): на одну полную копию меньше, но в Pillow
+      ядро 5x5 считается дольше двух 3x3 (25 умножений против 18),
+      поэтому по умолчанию слияние сверток выключено
+    """
+    
+    # Pillow поддерживает ядра только 3x3 и 5x5
+    MAX_KERNEL_SIZE = 5
+    
+    def __init__(self, fuse_kernels=False):
+        self.steps = []
+        self.fuse_kernels = fuse_kernels
+        self._compiled = None
+    
+    def kernel(self, size, weights, scale=None, offset=0):
+        """Добавляет свертку: size - сторона ядра, weights - веса построчно"""
+        weights = np.array(weights, dtype=np.float64).reshape(size, size)
+        scale = scale or weights.sum() or 1
+        self.steps.append(('kernel', weights / scale, float(offset)))
+        self._compiled = None
+        return self
+    
+    def builtin(self, name):
+        """Добавляет встроенный фильтр ImageFilter (SHARPEN, SMOOTH, ...)"""
+        (width, _), scale, offset, weights = getattr(ImageFilter, name).filterargs
+        return self.kernel(width, weights, scale, offset)
+    
+    def brightness(self, factor):
+        self.steps.append(('brightness', factor))
+        self._compiled = None
+        return self
+    
+    def contrast(self, factor):
+        self.steps.append(('contrast', factor))
+        self._compiled = None
+        return self
+    
+    def color(self, factor):
+        self.steps.append(('color', factor))
+        self._compiled = None
+        return self
+    
+    def sharpness(self, factor):
+        """Как ImageEnhance.Sharpness: f * x + (1 - f) * SMOOTH(x), то есть одна свертка"""
+        (width, _), scale, _, weights = ImageFilter.SMOOTH.filterargs
+        smooth = np.array(weights, dtype=np.float64).reshape(width, width) / scale
+        identity = np.zeros((width, width))
+        identity[width // 2, width // 2] = 1
+        return self.kernel(width, (factor * identity + (1 - factor) * smooth).flatten(), scale=1)
+    
+    @property
+    def radius(self):
+        """Сколько пикселей соседей нужно фильтрам (для нахлеста тайлов)"""
+        return sum(step[1].shape[0] // 2 for step in self.steps if step[0] == 'kernel')
+    
+    def compile(self):
+        """
+        Объединяет соседние шаги. Результат - список проходов:
+        ('kernel', веса, смещение) и ('point', [точечные шаги]).
+        """
+        if self._compiled is not None:
+            return self._compiled
+        
+        passes = []
+        for step in self.steps:
+            last = passes[-1] if passes else None
+            if step[0] == 'kernel':
+                if self.fuse_kernels and last and last[0] == 'kernel':
+                    fused = _fuse_kernels(last, step)
+                    if fused[1].shape[0] <= self.MAX_KERNEL_SIZE:
+                        passes[-1] = fused
+                        continue
+                passes.append(step)
+            else:
+                if last and last[0] == 'point':
+                    last[1].append(step)
+                else:
+                    passes.append(('point', [step]))
+        
+        self._compiled = passes
+        return passes
+    
+    def apply(self, img, means=None, stop=None):
+        """
+        Применяет скомпилированную цепочку: один проход на группу шагов.
+        means - {номер прохода: средние R, G, B на его входе по всему
+        изображению}; передается при обработке тайлов, чтобы контраст
+        считался от глобального среднего, а не от тайла.
+        stop - выполнить только первые stop проходов (для подсчета этих средних).
+        """
+        alpha = None
+        if img.mode == 'RGBA':
+            alpha = img.getchannel('A')
+            img = img.convert('RGB')
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        for index, compiled_pass in enumerate(self.compile()[:stop]):
+            if compiled_pass[0] == 'kernel':
+                _, weights, offset = compiled_pass
+                size = weights.shape[0]
+                img = img.filter(ImageFilter.Kernel(
+                    (size, size), weights.flatten().tolist(), scale=1, offset=offset))
+            else:
+                mean = (means or {}).get(index)
+                if mean is None and _needs_mean(compiled_pass):
+                    # Среднее по каналам нужно контрасту; берется из гистограммы (один проход)
+                    mean = ImageStat.Stat(img).mean
+                img = img.convert('RGB', _point_matrix(compiled_pass[1], mean))
+        
+        if alpha is not None:
+            img.putalpha(alpha)
+        return img
+
+def _needs_mean(compiled_pass):
+    """Нужно ли точечному проходу среднее входа (только контрасту)"""
+    return compiled_pass[0] == 'point' and any(kind == 'contrast' for kind, _ in compiled_pass[1])
+
+def _fuse_kernels(first, second):
+    """Одно ядро, эквивалентное двум сверткам подряд (без промежуточного округления)"""
+    _, k1, offset1 = first
+    _, k2, offset2 = second
+    size1, size2 = k1.shape[0], k2.shape[0]
+    fused = np.zeros((size1 + size2 - 1, size1 + size2 - 1))
+    for i in range(size2):
+        for j in range(size2):
+            fused[i:i + size1, j:j + size1] += k2[i, j] * k1
+    return ('kernel', fused, offset1 * k2.sum() + offset2)
+
+def _point_matrix(steps, mean):
+    """
+    Сворачивает точечные шаги в одну аффинную матрицу 3x4 для convert('RGB', matrix).
+    mean - средние R, G, B на входе группы; по нему считается среднее для контраста.
+    """
+    luma = np.array(LUMA_WEIGHTS)
+    matrix = np.hstack([np.eye(3), np.zeros((3, 1))])
+    for kind, factor in steps:
+        if kind == 'brightness':
+            step = np.hstack([factor * np.eye(3), np.zeros((3, 1))])
+        elif kind == 'contrast':
+            # Как ImageEnhance.Contrast: смешивание с серым средней яркости
+            current_mean = matrix[:, :3] @ np.array(mean) + matrix[:, 3]
+            gray = int(luma @ current_mean + 0.5)
+            step = np.hstack([factor * np.eye(3), np.full((3, 1), (1 - factor) * gray)])
+        elif kind == 'color':
+            # Как ImageEnhance.Color: смешивание с яркостью того же пикселя
+            step = np.hstack([factor * np.eye(3) + (1 - factor) * np.outer(np.ones(3), luma),
+                              np.zeros((3, 1))])
+        else:
+            raise ValueError(f"Неизвестный шаг: {kind}")
+        # Композиция аффинных преобразований: step(matrix(x))
+        matrix = np.hstack([step[:, :3] @ matrix[:, :3],
+                            (step[:, :3] @ matrix[:, 3] + step[:, 3])[:, np.newaxis]])
+    return tuple(matrix.flatten().tolist())
+
+# Параметры цепочки apply_complex_filters (входят в отпечаток манифеста)
+COMPLEX_FILTER_PARAMS = {
+    'filters': ('SHARPEN', 'SMOOTH'),
+    'contrast': 1.2,
+    'color': 1.1,
+    'fused': True
+}
+
+# Формат вывода по расширению файла
+OUTPUT_FORMATS = {
+    '.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP',
+    '.bmp': 'BMP', '.tif': 'TIFF', '.tiff': 'TIFF'
+}
+
+# Пресеты кодировщиков: fastest - без второго прохода Хаффмана и с быстрым zlib,
+# smallest - оптимизированные таблицы, progressive JPEG и максимальное сжатие
+ENCODER_PRESETS = {
+    'fastest': {
+        'JPEG': {'quality': 85, 'optimize': False, 'progressive': False, 'subsampling': '4:2:0'},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 80, 'method': 0}
+    },
+    'balanced': {
+        'JPEG': {'quality': 85, 'optimize': True, 'progressive': False, 'subsampling': '4:2:0'},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'quality': 80, 'method': 4}
+    },
+    'smallest': {
+        'JPEG': {'quality': 85, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'WEBP': {'quality': 80, 'method': 6}
+    }
+}
+
+# Настройки сохранения быстрой пакетной обработки (входят в отпечаток манифеста);
+# format - формат для файлов с незнакомым расширением
+FAST_SAVE_PARAMS = {'preset': 'fastest', 'format': 'JPEG'}
+
+def output_format(path, default=None):
+    """Формат PIL по расширению пути; незнакомое расширение -> default"""
+    fmt = OUTPUT_FORMATS.get(os.path.splitext(path)[1].lower(), default)
+    if fmt is None:
+        raise ValueError(f"Не удалось определить формат по расширению: {path}")
+    return fmt
+
+def encoder_options(fmt, preset=None):
+    """Параметры save() для формата и пресета (для прочих форматов - пустые)"""
+    preset = preset or FAST_SAVE_PARAMS['preset']
+    if preset not in ENCODER_PRESETS:
+        raise ValueError(f"Неизвестный пресет кодирования: {preset}")
+    return dict(ENCODER_PRESETS[preset].get(fmt, {}))
+
+def encode_image(img, fmt='JPEG', preset=None, buffer=None):
+    """
+    Кодирует изображение в BytesIO с настройками пресета.
+    JPEG не хранит альфу и палитру, а RGBX (кадры FrameCache) не пишет ни один
+    кодировщик - такие изображения приводятся к RGB.
+    """
+    if img.mode == 'RGBX' or (fmt == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK')):
+        img = img.convert('RGB')
+    buffer = buffer if buffer is not None else io.BytesIO()
+    img.save(buffer, fmt, **encoder_options(fmt, preset))
+    return buffer
+
+def save_image(img, path, preset=None, default_format=None):
+    """Сохраняет изображение в формате по расширению пути с настройками пресета"""
+    fmt = output_format(path, default_format or FAST_SAVE_PARAMS['format'])
+    LocalFiles.write(path, encode_image(img, fmt, preset).getbuffer())
+
+def benchmark_encoders(image=None, size=(1600, 1200), formats=('JPEG', 'PNG', 'WEBP'), repeat=3):
+    """
+    Время кодирования против размера для каждого формата и пресета.
+    Экономия считается относительно пресета fastest того же формата.
+    """
+    print("\n=== БЕНЧМАРК КОДИРОВЩИКОВ ===")
+    
+    if image is None:
+        # Фотоподобный кадр: плавный фон с шумом, чтобы сжатие было реалистичным
+        base = create_gradient(size, [(0.0, (40, 90, 160)), (1.0, (220, 180, 90))], 'radial')
+        noise = Image.merge('RGB', [Image.effect_noise(size, 25 + 10 * i) for i in range(3)])
+        image = Image.blend(base, noise, 0.15)
+    
+    results = {}
+    for fmt in formats:
+        if fmt == 'WEBP' and not features.check('webp'):
+            print("WEBP недоступен в этой сборке Pillow - пропускаем")
+            continue
+        baseline_bytes = None
+        for preset in ENCODER_PRESETS:
+            timings = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                size_bytes = encode_image(image, fmt, preset).tell()
+                timings.append(time.perf_counter() - start_time)
+            if baseline_bytes is None:
+                baseline_bytes = size_bytes
+            encode_ms = min(timings) * 1000
+            saved = 1 - size_bytes / baseline_bytes
+            results[(fmt, preset)] = {'encode_ms': encode_ms, 'bytes': size_bytes, 'saved': saved}
+            print(f"{fmt:<5} {preset:<9} {encode_ms:8.1f} мс  {size_bytes/1024:8.1f} КБ  "
+                  f"экономия {saved:6.1%}")
+    return results
+
+# Скомпилированные графы по параметрам цепочки
+_FILTER_GRAPHS = {}
+
+def complex_filter_graph():
+    """FilterGraph для apply_complex_filters, собранный из COMPLEX_FILTER_PARAMS"""
+    key = json.dumps(COMPLEX_FILTER_PARAMS, sort_keys=True)
+    graph = _FILTER_GRAPHS.get(key)
+    if graph is None:
+        graph = FilterGraph()
+        for filter_name in COMPLEX_FILTER_PARAMS['filters']:
+            graph.builtin(filter_name)
+        graph.contrast(COMPLEX_FILTER_PARAMS['contrast'])
+        graph.color(COMPLEX_FILTER_PARAMS['color'])
+        graph.compile()
+        _FILTER_GRAPHS[key] = graph
+    return graph
+
+# Цепочки умной обработки по типу изображения (см. smart_processing)
+SMART_PIPELINES = {}
+
+def smart_pipelines():
+    """
+    Цепочки SMART_PIPELINES: собираются и компилируются один раз на процесс
+    при первом обращении, а не при импорте (numpy и ImageFilter не нужны
+    командам, которые не обрабатывают изображения).
+    """
+    if not SMART_PIPELINES:
+        pipelines = {
+            # Легкое размытие фона и улучшение кожи
+            'portrait': FilterGraph().color(1.1).contrast(1.05),
+            # Усиление насыщенности и контраста
+            'landscape': FilterGraph().color(1.3).contrast(1.2).sharpness(1.5),
+            # Шумоподавление и коррекция яркости
+            'night': FilterGraph().builtin('SMOOTH').brightness(1.3),
+            # Ч/б (насыщенность 0), контраст и резкость
+            'text': FilterGraph().color(0.0).contrast(1.3).sharpness(2.0),
+            # Стандартное улучшение
+            'unknown': FilterGraph().contrast(1.1)
+        }
+        for pipeline in pipelines.values():
+            pipeline.compile()
+        SMART_PIPELINES.update(pipelines)
+    return SMART_PIPELINES
+
+def apply_complex_filters(img, fused=None, tile_size=None):
+    """
+    Имитация сложной обработки для тестирования производительности.
+    fused=True: контраст и насыщенность применяются одной цветовой матрицей,
+    без копии входа и без промежуточных серых изображений ImageEnhance
+    (отличие от пошагового пути - не больше пары уровней из-за округления).
+    tile_size: обработка перекрывающимися тайлами (см. apply_graph_tiled).
+    """
+    if fused is None:
+        fused = COMPLEX_FILTER_PARAMS['fused']
+    if (fused or tile_size) and img.mode in ('RGB', 'RGBA'):
+        if tile_size:
+            return apply_graph_tiled(img, complex_filter_graph(), tile_size)
+        return complex_filter_graph().apply(img)
+    
+    # Несколько операций для демонстрации
+    result = img.copy()
+    for filter_name in COMPLEX_FILTER_PARAMS['filters']:
+        result = result.filter(getattr(ImageFilter, filter_name))
+    enhancer = ImageEnhance.Contrast(result)
+    result = enhancer.enhance(COMPLEX_FILTER_PARAMS['contrast'])
+    enhancer = ImageEnhance.Color(result)
+    result = enhancer.enhance(COMPLEX_FILTER_PARAMS['color'])
+    return result
+
+def _filter_peak_rss(size, fused, tile_size=None):
+    """Прирост пикового RSS (КБ) при одном вызове apply_complex_filters; в отдельном процессе"""
+    import resource
+    
+    img = Image.merge('RGB', [Image.effect_noise(size, 50) for _ in range(3)])
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    apply_complex_filters(img, fused=fused, tile_size=tile_size)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def benchmark_filter_fusion(size=(1920, 1080), repeat=5):
+    """Пошаговая цепочка против скомпилированной: время, пиковая память, расхождение"""
+    print("\n=== БЕНЧМАРК СЛИЯНИЯ ФИЛЬТРОВ ===")
+    
+    img = Image.blend(
+        create_gradient(size, [(0.0, (20, 40, 200)), (1.0, (250, 180, 30))], kind='angular'),
+        Image.effect_noise(size, 50).convert('RGB'), 0.3)
+    
+    timings = {}
+    outputs = {}
+    for fused in (False, True):
+        best = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            outputs[fused] = apply_complex_filters(img, fused=fused)
+            best = min(best, time.perf_counter() - start_time)
+        timings[fused] = best
+    
+    # Пиковая память меряется в чистом процессе на каждый вариант
+    peak = {}
+    for fused in (False, True):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            peak[fused] = executor.submit(_filter_peak_rss, size, fused).result()
+    
+    diff = np.abs(np.asarray(outputs[False], dtype=np.int16) -
+                  np.asarray(outputs[True], dtype=np.int16))
+    
+    print(f"Размер: {size[0]}x{size[1]}")
+    print(f"Пошагово:  {timings[False]*1000:.1f} мс, пик памяти +{peak[False]/1024:.1f} МБ")
+    print(f"Слито:     {timings[True]*1000:.1f} мс, пик памяти +{peak[True]/1024:.1f} МБ")
+    print(f"Ускорение: {timings[False]/timings[True]:.2f}x, "
+          f"расхождение: среднее {diff.mean():.2f}, максимум {diff.max()}")
+    return {
+        'stepwise_seconds': timings[False],
+        'fused_seconds': timings[True],
+        'speedup': timings[False] / timings[True],
+        'stepwise_peak_kb': peak[False],
+        'fused_peak_kb': peak[True],
+        'mean_abs_diff': float(diff.mean()),
+        'max_abs_diff': int(diff.max())
+    }
+
+# Бюджет памяти на промежуточные буферы тайлов, одновременно находящихся в работе
+# (полные кадры входа и выхода в него не входят)
+TILE_BUDGET_BYTES = 256 * 1024 * 1024
+
+# Начиная с этого числа пикселей smart_processing переходит на тайлы
+TILED_AUTO_PIXELS = 64 * 1024 * 1024
+
+def tile_boxes(size, tile_size):
+    """Прямоугольники тайлов (left, top, right, bottom), покрывающие изображение"""
+    width, height = size
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            yield (left, top, min(left + tile_size, width), min(top + tile_size, height))
+
+def _process_tile(img, graph, box, halo, means, stop=None):
+    """Обрабатывает тайл с нахлестом halo и вырезает из результата только сам тайл"""
+    left, top, right, bottom = box
+    outer = (max(left - halo, 0), max(top - halo, 0),
+             min(right + halo, img.width), min(bottom + halo, img.height))
+    result = graph.apply(img.crop(outer), means=means, stop=stop)
+    inner = (left - outer[0], top - outer[1], right - outer[0], bottom - outer[1])
+    return result.crop(inner)
+
+def _tile_histogram(img, graph, box, halo, means, stop):
+    """Гистограмма R, G, B тайла после первых stop проходов графа"""
+    return _process_tile(img, graph, box, halo, means, stop).convert('RGB').histogram()
+
+def _run_tiles(executor, boxes, task, max_in_flight, consume):
+    """Запускает task(box) по тайлам, держа в работе не больше max_in_flight; consume(box, результат)"""
+    pending = {}
+    for box in boxes:
+        if len(pending) >= max_in_flight:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                consume(pending.pop(future), future.result())
+        future = executor.submit(task, box)
+        pending[future] = box
+    for future in list(pending):
+        consume(pending.pop(future), future.result())
+
+def apply_graph_tiled(img, graph, tile_size=1024, workers=None,
+                      tile_budget_bytes=TILE_BUDGET_BYTES):
+    """
+    Применяет FilterGraph по тайлам tile_size x tile_size параллельно.
+    - нахлест тайлов равен радиусу всех сверток графа, поэтому швов нет:
+      каждый пиксель видит тех же соседей, что и при обработке целиком
+    - контраст считается от среднего всего изображения на входе своего
+      прохода: если перед ним есть свертки, сначала отдельный проход по
+      тайлам считает их гистограммы и складывает (с учетом обрезки
+      значений свертками), поэтому результат совпадает с обработкой целиком
+      ценой повторного выполнения сверток
+    - одновременно в работе не больше тайлов, чем влезает в tile_budget_bytes:
+      промежуточные копии сверток и матриц не растут с размером изображения
+    Тайлами разбиты только вычисления. Вход img уже декодирован целиком, а
+    выход - полный кадр того же размера (Pillow не декодирует и не кодирует
+    JPEG/PNG по областям), поэтому пик памяти - примерно вход + выход +
+    бюджет тайлов, а не бюджет. Кадр, для которого не хватает памяти на
+    вход и выход (например, скан 30k x 30k), этот путь не спасает.
+    """
+    halo = graph.radius
+    output = Image.new(img.mode if img.mode == 'RGBA' else 'RGB', img.size)
+    
+    # Вход тайла, результаты сверток и выход: ~3 буфера по 4 байта на пиксель
+    tile_bytes = (tile_size + 2 * halo) ** 2 * 4 * 3
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max(1, min(workers, tile_budget_bytes // tile_bytes))
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        means = {}
+        for index, compiled_pass in enumerate(graph.compile()):
+            if not _needs_mean(compiled_pass):
+                continue
+            if index == 0:
+                histogram = img.convert('RGB').histogram()
+            else:
+                histograms = []
+                _run_tiles(executor, tile_boxes(img.size, tile_size),
+                           lambda box: _tile_histogram(img, graph, box, halo, means, index),
+                           max_in_flight, lambda box, tile_histogram: histograms.append(tile_histogram))
+                histogram = [sum(counts) for counts in zip(*histograms)]
+            means[index] = ImageStat.Stat(histogram).mean
+        
+        _run_tiles(executor, tile_boxes(img.size, tile_size),
+                   lambda box: _process_tile(img, graph, box, halo, means),
+                   max_in_flight, lambda box, tile: output.paste(tile, box[:2]))
+    return output
+
+def benchmark_tiled_filters(size=(8000, 8000), tile_size=1024):
+    """Цепочка фильтров целиком и по тайлам: время, пиковая память, швы"""
+    print("\n=== БЕНЧМАРК ТАЙЛОВОЙ ОБРАБОТКИ ===")
+    
+    img = Image.merge('RGB', [Image.effect_noise(size, 50) for _ in range(3)])
+    start_time = time.perf_counter()
+    whole = apply_complex_filters(img)
+    whole_time = time.perf_counter() - start_time
+    
+    start_time = time.perf_counter()
+    tiled = apply_complex_filters(img, tile_size=tile_size)
+    tiled_time = time.perf_counter() - start_time
+    
+    peak = {}
+    for tiles in (None, tile_size):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            peak[tiles] = executor.submit(_filter_peak_rss, size, True, tiles).result()
+    
+    diff = np.abs(np.asarray(whole, dtype=np.int16) - np.asarray(tiled, dtype=np.int16))
+    
+    print(f"Размер: {size[0]}x{size[1]}, тайл {tile_size}")
+    print(f"Целиком:  {whole_time:.2f} с, пик памяти +{peak[None]/1024:.0f} МБ")
+    print(f"Тайлы:    {tiled_time:.2f} с, пик памяти +{peak[tile_size]/1024:.0f} МБ")
+    print(f"Расхождение: максимум {diff.max()}")
+    return {
+        'whole_seconds': whole_time,
+        'tiled_seconds': tiled_time,
+        'whole_peak_kb': peak[None],
+        'tiled_peak_kb': peak[tile_size],
+        'max_abs_diff': int(diff.max())
+    }
+
+def filters_fingerprint():
+    """Отпечаток параметров фильтров и сохранения: меняется - все выходы устарели"""
+    params = {'filters': COMPLEX_FILTER_PARAMS, 'save': FAST_SAVE_PARAMS,
+              'encoder': ENCODER_PRESETS[FAST_SAVE_PARAMS['preset']]}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def file_content_hash(path, chunk_size=1 << 20):
+    """Хеш содержимого файла (blake2b), читается блоками"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BatchManifest:
+    """
+    Манифест инкрементальной обработки в SQLite.
+    Для каждого исходника хранит mtime, размер, хеш содержимого,
+    отпечаток фильтров и путь к результату.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " source TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER, size INTEGER, content_hash TEXT,"
+            " fingerprint TEXT, output TEXT)")
+        self.conn.commit()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+    
+    def is_up_to_date(self, source, output, fingerprint):
+        """
+        True, если результат актуален. Сначала сверяются mtime и размер,
+        хеш считается только если mtime изменился, а размер нет.
+        """
+        row = self.conn.execute(
+            "SELECT mtime_ns, size, content_hash, fingerprint, output FROM files WHERE source = ?",
+            (source,)).fetchone()
+        if row is None:
+            return False
+        mtime_ns, size, content_hash, old_fingerprint, old_output = row
+        if old_fingerprint != fingerprint or old_output != output or not os.path.exists(output):
+            return False
+        
+        stat = os.stat(source)
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == mtime_ns:
+            return True
+        
+        # Файл "потрогали", но содержимое то же - обновляем mtime и пропускаем
+        if file_content_hash(source) == content_hash:
+            self.conn.execute("UPDATE files SET mtime_ns = ? WHERE source = ?",
+                              (stat.st_mtime_ns, source))
+            return True
+        return False
+    
+    def record(self, source, output, fingerprint):
+        """Запоминает успешно обработанный файл"""
+        stat = os.stat(source)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (source, stat.st_mtime_ns, stat.st_size, file_content_hash(source),
+             fingerprint, output))
+    
+    def remove_stale(self, current_sources):
+        """Удаляет результаты и записи для исходников, которых больше нет"""
+        current_sources = set(current_sources)
+        stale = [(source, output) for source, output
+                 in self.conn.execute("SELECT source, output FROM files")
+                 if source not in current_sources]
+        for source, output in stale:
+            if os.path.exists(output):
+                os.remove(output)
+            self.conn.execute("DELETE FROM files WHERE source = ?", (source,))
+        self.conn.commit()
+        return len(stale)
+
+# Размер dHash: (DHASH_SIZE + 1) x DHASH_SIZE пикселей -> DHASH_SIZE ** 2 бит
+DHASH_SIZE = 8
+# Порог Хэмминга, до которого изображения считаются почти одинаковыми
+DEDUPE_MAX_DISTANCE = 6
+# Режимы дедупликации пакетных путей
+DEDUPE_MODES = ('skip', 'group')
+
+def dhash(img, hash_size=DHASH_SIZE):
+    """Разностный хеш: знак перепада яркости между соседними пикселями строки"""
+    small = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX),
+                       dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def image_dhash(path, hash_size=DHASH_SIZE):
+    """dHash файла по уменьшенному при загрузке кадру; None, если файл не читается"""
+    try:
+        return dhash(load_image_for_size(path, (hash_size + 1, hash_size), reducing_gap=4.0),
+                     hash_size)
+    except Exception as e:
+        print(f"Ошибка хеширования {os.path.basename(path)}: {e}")
+        return None
+
+def hamming_distance(first, second):
+    """Число различающихся бит двух хешей"""
+    return (first ^ second).bit_count()
+
+class MultiIndexHash:
+    """
+    Мульти-индекс для поиска хешей в радиусе Хэмминга max_distance: хеш
+    режется на max_distance + 1 отрезков, и у любого соседа в радиусе хотя
+    бы один отрезок совпадает точно (принцип Дирихле). Поиск проверяет только
+    кандидатов из этих корзин, а не все хеши.
+    """
+    
+    def __init__(self, max_distance=DEDUPE_MAX_DISTANCE, bits=DHASH_SIZE ** 2):
+        self.max_distance = max_distance
+        count = max_distance + 1
+        bounds = [bits * i // count for i in range(count + 1)]
+        self.segments = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+        self.buckets = [{} for _ in self.segments]
+        self.values = []
+        self.items = []
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def add(self, value, item):
+        """Добавляет хеш value с привязанным объектом item"""
+        position = len(self.values)
+        self.values.append(value)
+        self.items.append(item)
+        for (shift, mask), bucket in zip(self.segments, self.buckets):
+            bucket.setdefault((value >> shift) & mask, []).append(position)
+    
+    def find(self, value, max_distance=None):
+        """Все (расстояние, item) в радиусе max_distance, ближние первыми"""
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"Радиус {max_distance} больше радиуса индекса {self.max_distance}")
+        candidates = set()
+        for (shift, mask), bucket in zip(self.segments, self.buckets):
+            candidates.update(bucket.get((value >> shift) & mask, ()))
+        found = []
+        for position in candidates:
+            distance = hamming_distance(value, self.values[position])
+            if distance <= max_distance:
+                found.append((distance, position))
+        found.sort()
+        return [(distance, self.items[position]) for distance, position in found]
+
+class PerceptualHashIndex:
+    """
+    Постоянный индекс dHash в SQLite: хеш пересчитывается, только если
+    у файла изменились mtime или размер. ':memory:' - индекс на один запуск.
+    """
+    
+    def __init__(self, path=':memory:', hash_size=DHASH_SIZE):
+        self.path = path
+        self.hash_size = hash_size
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " source TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER, size INTEGER, hash_size INTEGER, dhash TEXT)")
+        self.conn.commit()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+    
+    def cached(self, path, stat):
+        """Сохраненный хеш, если файл не менялся, иначе None"""
+        row = self.conn.execute(
+            "SELECT dhash FROM hashes WHERE source = ? AND mtime_ns = ? AND size = ?"
+            " AND hash_size = ?",
+            (path, stat.st_mtime_ns, stat.st_size, self.hash_size)).fetchone()
+        return int(row[0], 16) if row else None
+    
+    def hashes(self, paths, executor=None, chunksize=1):
+        """
+        Хеши для paths в том же порядке (None для нечитаемых файлов).
+        Отсутствующие в индексе считаются через executor.map, если он задан.
+        """
+        result = {}
+        missing = []
+        for path in paths:
+            stat = os.stat(path)
+            value = self.cached(path, stat)
+            if value is None:
+                missing.append((path, stat))
+            else:
+                result[path] = value
+        
+        missing_paths = [path for path, _ in missing]
+        sizes = [self.hash_size] * len(missing_paths)
+        if executor is not None:
+            computed = executor.map(image_dhash, missing_paths, sizes, chunksize=chunksize)
+        else:
+            computed = map(image_dhash, missing_paths, sizes)
+        rows = []
+        for (path, stat), value in zip(missing, computed):
+            result[path] = value
+            if value is not None:
+                rows.append((path, stat.st_mtime_ns, stat.st_size, self.hash_size,
+                             f"{value:x}"))
+        self.conn.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+        return [result[path] for path in paths]
+
+def find_duplicates(paths, hashes, max_distance=DEDUPE_MAX_DISTANCE):
+    """
+    Почти-дубликаты в порядке paths: первый файл группы - представитель,
+    остальные ищутся в мульти-индексе представителей.
+    Возвращает {дубликат: представитель}.
+    """
+    representatives = MultiIndexHash(max_distance)
+    duplicates = {}
+    for path, value in zip(paths, hashes):
+        if value is None:
+            continue
+        match = representatives.find(value)
+        if match:
+            duplicates[path] = match[0][1]
+        else:
+            representatives.add(value, path)
+    return duplicates
+
+def dedupe_paths(paths, index_path=None, max_distance=DEDUPE_MAX_DISTANCE, max_workers=4,
+                 backend='auto', executor=None):
+    """
+    Делит paths на уникальные и почти-дубликаты по dHash.
+    index_path - файл постоянного индекса (None - только в памяти);
+    executor - уже открытый пул, иначе он выбирается по backend.
+    Возвращает (уникальные пути, {дубликат: представитель}).
+    """
+    paths = list(paths)
+    chunksize = choose_chunksize(len(paths), max_workers)
+    with PerceptualHashIndex(index_path or ':memory:') as index:
+        if executor is not None:
+            hashes = index.hashes(paths, executor, chunksize)
+        elif resolve_backend(backend, len(paths), max_workers) == 'process':
+            hashes = index.hashes(paths, get_process_pool(max_workers), chunksize)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                hashes = index.hashes(paths, pool)
+    duplicates = find_duplicates(paths, hashes, max_distance)
+    unique = [path for path in paths if path not in duplicates]
+    if duplicates:
+        print(f"Найдено почти-дубликатов: {len(duplicates)} из {len(paths)}")
+    return unique, duplicates
+
+def slow_batch_processor(input_folder, output_folder):
+    """Медленная версия обработки (для сравнения)"""
+    print("Запуск медленной обработки...")
+    os.makedirs(output_folder, exist_ok=True)
+    
+    processed_count = 0
+    for input_path in iter_image_files(input_folder):
+        filename = os.path.basename(input_path)
+        output_path = os.path.join(output_folder, f"slow_{filename}")
+        
+        with Image.open(input_path) as img:
+            result = apply_complex_filters(img)
+            result.save(output_path)
+        
+        processed_count += 1
+        print(f"Медленная обработка: {filename}")
+    
+    print(f"Медленная обработка завершена: {processed_count} файлов")
+
+class LocalFiles:
+    """Чтение и запись файлов целиком (точка подмены для сетевых ФС и тестов)"""
+    
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    
+    @staticmethod
+    def write(path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+class DelayedFiles(LocalFiles):
+    """Локальные файлы с искусственной задержкой: имитация NFS для бенчмарков"""
+    
+    def __init__(self, read_latency=0.05, write_latency=0.05):
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+    
+    def read(self, path):
+        time.sleep(self.read_latency)
+        return LocalFiles.read(path)
+    
+    def write(self, path, data):
+        time.sleep(self.write_latency)
+        LocalFiles.write(path, data)
+
+def worker_id():
+    """Идентификатор воркера для метрик: pid и имя потока"""
+    return f"{os.getpid()}:{threading.current_thread().name}"
+
+@contextlib.contextmanager
+def timed_stage(timings, stage):
+    """Добавляет длительность блока в timings[stage]; при timings=None ничего не меряет"""
+    if timings is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start_time
+
+class StageMetrics:
+    """
+    Метрики конвейера по стадиям и воркерам: число вызовов, суммарное
+    и максимальное время, байты чтения и записи, ожидание в очередях.
+    Данные приходят из словарей-результатов воркеров (record_result), поэтому
+    работает одинаково для потоков и процессов.
+    sample_rate < 1: время стадий меряется только у доли файлов, счетчики
+    файлов и байтов ведутся всегда. events_path - JSON lines по каждому
+    замеренному файлу.
+    """
+    
+    def __init__(self, sample_rate=1.0, events_path=None):
+        self.sample_rate = sample_rate
+        self.events_path = events_path
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+    
+    def should_sample(self):
+        """Решает, замерять ли стадии очередного файла"""
+        return self.sample_rate >= 1.0 or self._random.random() < self.sample_rate
+    
+    def observe(self, stage, seconds, worker='main'):
+        with self._lock:
+            entry = self._stages.setdefault((stage, worker), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+    
+    def add(self, counter, value, **labels):
+        key = (counter, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def record_result(self, result):
+        """
+        Учитывает результат обработки одного файла. Если стадии выполняли
+        разные потоки (конвейер), stage_workers - {стадия: воркер}; иначе
+        все стадии относятся к worker.
+        """
+        worker = result.get('worker', 'main')
+        stage_workers = result.get('stage_workers') or {}
+        status = 'skipped' if result.get('skipped') else ('ok' if result['ok'] else 'error')
+        self.add('files_total', 1, status=status)
+        self.add('bytes_read_total', result.get('bytes_read', 0),
+                 worker=stage_workers.get('open', worker))
+        self.add('bytes_written_total', result.get('bytes_written', 0),
+                 worker=stage_workers.get('write', worker))
+        timings = result.get('timings')
+        if timings:
+            for stage, seconds in timings.items():
+                self.observe(stage, seconds, stage_workers.get(stage, worker))
+            if self.events_path:
+                event = {'ts': time.time(), 'file': result['file'], 'worker': worker,
+                         'stage_workers': stage_workers, 'ok': result['ok'], 'timings': timings,
+                         'bytes_read': result.get('bytes_read', 0),
+                         'bytes_written': result.get('bytes_written', 0)}
+                with self._lock, open(self.events_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+    
+    def snapshot(self):
+        """Текущее состояние в виде сериализуемого словаря"""
+        with self._lock:
+            return {
+                'stages': [{'stage': stage, 'worker': worker, 'count': count,
+                            'seconds_total': total, 'seconds_max': maximum}
+                           for (stage, worker), (count, total, maximum) in sorted(self._stages.items())],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self._counters.items())]
+            }
+    
+    def to_prometheus(self, prefix='image_pipeline'):
+        """Текстовый формат Prometheus (для node_exporter textfile collector)"""
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter",
+                 f"# TYPE {prefix}_stage_calls_total counter",
+                 f"# TYPE {prefix}_stage_seconds_max gauge"]
+        for s in snapshot['stages']:
+            labels = f'stage="{s["stage"]}",worker="{s["worker"]}"'
+            lines.append(f"{prefix}_stage_seconds_total{{{labels}}} {s['seconds_total']:.6f}")
+            lines.append(f"{prefix}_stage_calls_total{{{labels}}} {s['count']}")
+            lines.append(f"{prefix}_stage_seconds_max{{{labels}}} {s['seconds_max']:.6f}")
+        for name in sorted({c['name'] for c in snapshot['counters']}):
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for c in snapshot['counters']:
+                if c['name'] == name:
+                    labels = ",".join(f'{k}="{v}"' for k, v in c['labels'].items())
+                    lines.append(f"{prefix}_{name}{{{labels}}} {c['value']}")
+        lines.append(f"# TYPE {prefix}_sample_rate gauge")
+        lines.append(f"{prefix}_sample_rate {self.sample_rate}")
+        return "\n".join(lines) + "\n"
+    
+    def write_prometheus(self, path, prefix='image_pipeline'):
+        """Пишет метрики атомарно (через временный файл), как ждет textfile collector"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(tmp_path, path)
+    
+    def write_jsonl(self, path):
+        """Дописывает сводку по стадиям в JSON lines: одна строка на стадию и воркер"""
+        ts = time.time()
+        with open(path, 'a', encoding='utf-8') as f:
+            for s in self.snapshot()['stages']:
+                f.write(json.dumps(dict(s, ts=ts), ensure_ascii=False) + "\n")
+    
+    def report(self):
+        """Печатает сводку: среднее время стадий по всем воркерам"""
+        totals = {}
+        for s in self.snapshot()['stages']:
+            entry = totals.setdefault(s['stage'], [0, 0.0])
+            entry[0] += s['count']
+            entry[1] += s['seconds_total']
+        for stage, (count, total) in totals.items():
+            print(f"  {stage:<11} {count:>6} раз, среднее {total / count * 1000:8.2f} мс")
+
+# Минимальное число файлов, при котором режим auto выбирает процессы
+AUTO_PROCESS_MIN_FILES = 8
+
+# Прогретые пулы процессов: создаются один раз и переиспользуются между вызовами
+_PROCESS_POOLS = {}
+
+def transform_image_bytes(data, timings=None, fmt=None):
+    """
+    CPU-часть обработки файла: байты исходника -> байты результата в формате fmt
+    (по умолчанию FAST_SAVE_PARAMS['format']).
+    Не трогает диск, поэтому подходит для любого источника данных.
+    """
+    with timed_stage(timings, 'decode'):
+        img = Image.open(io.BytesIO(data))
+        img.load()
+
+    # Предварительная обработка и кэширование в памяти
+    with timed_stage(timings, 'convert'):
         if img.mode != 'RGB':
             img = img.convert('RGB')
+
+    with timed_stage(timings, 'filter'):
+        result = apply_complex_filters(img)
+
+    # Настройки сохранения из пресета FAST_SAVE_PARAMS
+    with timed_stage(timings, 'encode'):
+        buffer = encode_image(result, fmt or FAST_SAVE_PARAMS['format'])
+    return buffer.getvalue()
+
+def _transform_task(data, timed, fmt=None):
+    """Задача для CPU-пула: возвращает байты результата и длительности стадий"""
+    timings = {} if timed else None
+    return transform_image_bytes(data, timings, fmt), timings, worker_id()
+
+def process_single_file(input_path, output_path, timed=False):
+    """
+    Обрабатывает один файл. Выполняется и в потоке, и в процессе-воркере,
+    поэтому принимает пути, а не объекты Image, и возвращает словарь с итогом.
+    timed=True: в результат попадают длительности стадий open, decode,
+    convert, filter, encode и write (их собирает StageMetrics в родителе).
+    """
+    filename = os.path.basename(input_path)
+    timings = {} if timed else None
+    try:
+        with timed_stage(timings, 'open'):
+            data = LocalFiles.read(input_path)
+
+        fmt = output_format(output_path, FAST_SAVE_PARAMS['format'])
+        encoded = transform_image_bytes(data, timings, fmt)
+
+        with timed_stage(timings, 'write'):
+            LocalFiles.write(output_path, encoded)
+
+        return {'file': filename, 'output': output_path, 'ok': True, 'error': None,
+                'timings': timings, 'bytes_read': len(data),
+                'bytes_written': len(encoded), 'worker': worker_id()}
+
+    except Exception as e:
+        return {'file': filename, 'output': output_path, 'ok': False, 'error': str(e),
+                'timings': timings, 'worker': worker_id()}
+
+def _worker_pid(_):
+    """Пустая задача для прогрева воркеров"""
+    return os.getpid()
+
+def get_process_pool(max_workers):
+    """Возвращает прогретый пул процессов на max_workers воркеров"""
+    pool = _PROCESS_POOLS.get(max_workers)
+    if pool is None:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        # Запускаем все воркеры сразу, чтобы первый батч не платил за старт
+        list(pool.map(_worker_pid, range(max_workers)))
+        _PROCESS_POOLS[max_workers] = pool
+    return pool
+
+def shutdown_process_pools():
+    """Останавливает все прогретые пулы процессов"""
+    for pool in _PROCESS_POOLS.values():
+        pool.shutdown()
+    _PROCESS_POOLS.clear()
+
+def choose_chunksize(file_count, max_workers):
+    """Размер чанка для пула процессов: ~4 чанка на воркер сглаживают разброс по файлам"""
+    return max(1, file_count // (max_workers * 4))
+
+def resolve_backend(backend, file_count, max_workers):
+    """Выбирает thread или process; auto смотрит на число ядер, воркеров и файлов"""
+    if backend == 'auto':
+        if (os.cpu_count() or 1) > 1 and max_workers > 1 and file_count >= AUTO_PROCESS_MIN_FILES:
+            return 'process'
+        return 'thread'
+    if backend not in ('thread', 'process'):
+        raise ValueError(f"Неизвестный режим исполнения: {backend}")
+    return backend
+
+def _collect_batch_results(results_iter, label="Быстрая обработка", metrics=None):
+    """Собирает результаты воркеров в родительском процессе, печатает и учитывает в метриках"""
+    results = []
+    for result in results_iter:
+        if metrics is not None:
+            metrics.record_result(result)
+        if result['ok']:
+            print(f"{label}: {result['file']}")
+        else:
+            print(f"Ошибка обработки {result['file']}: {result['error']}")
+        results.append(result)
+    return results
+
+def optimized_batch_processor(input_folder, output_folder, max_workers=4,
+                              backend='thread', return_results=False, manifest_path=None,
+                              metrics=None, dedupe=None, hash_index_path=None,
+                              dedupe_distance=DEDUPE_MAX_DISTANCE):
+    """
+    Оптимизированная параллельная версия.
+    backend: 'thread' - пул потоков, 'process' - пул процессов (обходит GIL),
+    'auto' - выбор по числу ядер и файлов.
+    manifest_path: файл SQLite-манифеста для инкрементального режима -
+    неизменившиеся файлы пропускаются, результаты удаленных исходников стираются.
+    dedupe: почти-дубликаты по dHash не обрабатываются - 'skip' (без результата)
+    или 'group' (результат представителя группы); hash_index_path - постоянный
+    индекс хешей, dedupe_distance - порог Хэмминга.
+    metrics: StageMetrics для времени стадий по файлам и воркерам.
+    При return_results=True возвращает список результатов по каждому файлу.
+    """
+    print("Запуск оптимизированной обработки...")
+
+    # Создаем выходную папку если нет
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Собираем пути заранее: число файлов нужно для выбора режима и чанков.
+    # Для папок без ограничения по размеру есть streaming_batch_processor
+    input_paths = list(iter_image_files(input_folder))
+    files = [os.path.basename(p) for p in input_paths]
+    output_paths = [os.path.join(output_folder, f"fast_{f}") for f in files]
+    total_count = len(files)
+    # Все найденные исходники: устаревшими считаются только записи исчезнувших
+    # файлов, а не дубликатов, которые дедупликация убрала из обработки
+    walked_paths = input_paths
+
+    duplicates = []
+    if dedupe:
+        if dedupe not in DEDUPE_MODES:
+            raise ValueError(f"Неизвестный режим дедупликации: {dedupe}")
+        output_by_input = dict(zip(input_paths, output_paths))
+        input_paths, duplicate_of = dedupe_paths(input_paths, hash_index_path, dedupe_distance,
+                                                 max_workers, backend)
+        duplicates = list(duplicate_of.items())
+        output_paths = [output_by_input[p] for p in input_paths]
+        files = [os.path.basename(p) for p in input_paths]
+
+    skipped = []
+    # Итог по исходнику - для дубликатов, которые наследуют итог представителя
+    by_source = {}
+    manifest = None
+    if manifest_path:
+        manifest = BatchManifest(manifest_path)
+        fingerprint = filters_fingerprint()
+        removed = manifest.remove_stale(walked_paths)
+        if removed:
+            print(f"Удалено устаревших результатов: {removed}")
+        pending = []
+        for input_path, output_path in zip(input_paths, output_paths):
+            if manifest.is_up_to_date(input_path, output_path, fingerprint):
+                skipped.append({'file': os.path.basename(input_path), 'output': output_path,
+                                'ok': True, 'error': None, 'skipped': True})
+                by_source[input_path] = skipped[-1]
+            else:
+                pending.append((input_path, output_path))
+        input_paths = [p[0] for p in pending]
+        output_paths = [p[1] for p in pending]
+        files = [os.path.basename(p) for p in input_paths]
+
+    backend = resolve_backend(backend, len(files), max_workers)
+    timed = [metrics is not None and metrics.should_sample() for _ in input_paths]
+
+    if backend == 'process':
+        # В процессы уходят только пути, изображения не сериализуются
+        pool = get_process_pool(max_workers)
+        chunksize = choose_chunksize(len(files), max_workers)
+        results = _collect_batch_results(
+            pool.map(process_single_file, input_paths, output_paths, timed,
+                     chunksize=chunksize), metrics=metrics)
+    else:
+        # Используем ThreadPoolExecutor для параллельной обработки
+        # (постоянные имена потоков - стабильные метки воркеров в метриках)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch') as executor:
+            results = _collect_batch_results(
+                executor.map(process_single_file, input_paths, output_paths, timed),
+                metrics=metrics)
+
+    if manifest is not None:
+        for input_path, result in zip(input_paths, results):
+            if result['ok']:
+                manifest.record(input_path, result['output'], fingerprint)
+        manifest.close()
+    if duplicates:
+        # Дубликат получает итог своего представителя (в режиме group - и его файл)
+        by_source.update(zip(input_paths, results))
+        for path, representative in duplicates:
+            source_result = by_source[representative]
+            skipped.append({'file': os.path.basename(path),
+                            'output': source_result['output'] if dedupe == 'group' else None,
+                            'ok': source_result['ok'], 'error': source_result['error'],
+                            'skipped': True, 'duplicate_of': representative})
+    if metrics is not None:
+        for result in skipped:
+            metrics.record_result(result)
+    results = skipped + results
+
+    success_count = sum(1 for r in results if r['ok'])
+    print(f"Оптимизированная обработка завершена: {success_count}/{total_count} файлов")
+    if len(skipped) > len(duplicates):
+        print(f"Пропущено без изменений: {len(skipped) - len(duplicates)}")
+    if duplicates:
+        print(f"Пропущено почти-дубликатов: {len(duplicates)}")
+    if return_results:
+        return results
+    return success_count
+
+def benchmark_batch_scaling(input_folder, output_folder, workers=(1, 2, 4, 8, 16),
+                            backends=('thread', 'process')):
+    """Масштабирование пакетной обработки по числу воркеров для каждого режима"""
+    print("\n=== МАСШТАБИРОВАНИЕ ПАКЕТНОЙ ОБРАБОТКИ ===")
+
+    results = []
+    for backend in backends:
+        base_time = None
+        for count in workers:
+            if backend == 'process':
+                # Прогрев вне замера: пул переиспользуется, как в рабочем режиме
+                get_process_pool(count)
+
+            start_time = time.perf_counter()
+            processed = optimized_batch_processor(input_folder, output_folder,
+                                                  max_workers=count, backend=backend)
+            elapsed = time.perf_counter() - start_time
+            if base_time is None:
+                base_time = elapsed
+
+            results.append({
+                'backend': backend,
+                'workers': count,
+                'files': processed,
+                'seconds': elapsed,
+                'speedup': base_time / elapsed
+            })
+
+    print("\nРежим    Воркеры  Время, с  Ускорение")
+    for r in results:
+        print(f"{r['backend']:<8} {r['workers']:>7}  {r['seconds']:>8.2f}  {r['speedup']:>8.2f}x")
+
+    shutdown_process_pools()
+    return results
+
+# Аренда задания очереди: не продленная вовремя считается брошенной
+WORK_LEASE_SECONDS = 300
+# Сколько раз задание выдается, прежде чем считается окончательно упавшим
+WORK_MAX_ATTEMPTS = 3
+# Как часто воркер проверяет чужие аренды, когда свободных заданий нет
+WORK_POLL_SECONDS = 1.0
+
+def shard_of(relative_path, shard_count):
+    """
+    Шард файла по хешу относительного пути: одинаков на всех хостах,
+    даже если дерево смонтировано в разные места.
+    """
+    digest = hashlib.blake2b(relative_path.replace(os.sep, '/').encode('utf-8'), digest_size=8)
+    return int.from_bytes(digest.digest(), 'big') % shard_count
+
+def shard_queue_path(queue_dir, shard_index, shard_count):
+    """Файл очереди шарда: у каждого шарда своя база, шарды не делят блокировки"""
+    return os.path.join(queue_dir, f"shard_{shard_index:03d}_of_{shard_count:03d}.sqlite")
+
+class WorkQueue:
+    """
+    Постоянная очередь заданий в SQLite. Задание выдается воркеру в аренду
+    на lease_seconds; аренду умершего воркера забирает другой. Ошибка
+    возвращает задание в очередь, пока не исчерпано max_attempts попыток.
+    Выполненные задания при перезапуске не выдаются повторно.
+    Время аренды - по часам хостов (они должны быть синхронизированы).
+    """
+    
+    def __init__(self, path, lease_seconds=WORK_LEASE_SECONDS, max_attempts=WORK_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Автокоммит: транзакции открываются явно там, где нужна атомарность
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " source TEXT PRIMARY KEY, output TEXT,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT, lease_expires REAL, error TEXT, finished REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self.conn.close()
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Транзакция с блокировкой записи сразу (два воркера не возьмут одно задание)"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+    
+    def enqueue(self, jobs):
+        """Добавляет (source, output); уже известные задания не трогаются (возобновление)"""
+        with self._transaction():
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO jobs (source, output) VALUES (?, ?)",
+                                  jobs)
+            return self.conn.total_changes - before
+    
+    def claim(self, owner, limit=1):
+        """
+        Берет в аренду до limit заданий: новые, вернувшиеся после ошибки и
+        с истекшей арендой. Задание, чья аренда истекла на последней
+        попытке, помечается упавшим. Возвращает [(source, output)].
+        """
+        now = time.time()
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'аренда истекла', lease_owner = NULL"
+                " WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts))
+            rows = self.conn.execute(
+                "SELECT source, output FROM jobs WHERE status = 'pending'"
+                " OR (status = 'leased' AND lease_expires < ?) ORDER BY source LIMIT ?",
+                (now, limit)).fetchall()
+            self.conn.executemany(
+                "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE source = ?",
+                [(owner, now + self.lease_seconds, source) for source, _ in rows])
+        return rows
+    
+    def renew(self, sources, owner):
+        """Продлевает аренду своих заданий (для долгих пакетов)"""
+        with self._transaction():
+            self.conn.executemany(
+                "UPDATE jobs SET lease_expires = ? WHERE source = ? AND lease_owner = ?"
+                " AND status = 'leased'",
+                [(time.time() + self.lease_seconds, source, owner) for source in sources])
+    
+    @contextlib.contextmanager
+    def heartbeat(self, sources, owner):
+        """
+        Пока пакет обрабатывается, фоновый поток продлевает аренду sources
+        каждые lease_seconds / 3. У потока свое соединение: соединения
+        SQLite нельзя делить между потоками. Завершенные задания renew
+        не трогает, поэтому sources можно не сокращать.
+        """
+        stop_event = threading.Event()
         
-        # Получаем гистограмму
-        hist = img.histogram()
+        def run():
+            with WorkQueue(self.path, self.lease_seconds, self.max_attempts) as work_queue:
+                while not stop_event.wait(self.lease_seconds / 3):
+                    work_queue.renew(sources, owner)
         
-        # Анализируем доминирующий цвет
-        r_hist = hist[0:256]
-        g_hist = hist[256:512] 
-        b_hist = hist[512:768]
-        
-        # Находим наиболее частые значения для каждого канала
-        r_dominant = r_hist.index(max(r_hist))
-        g_dominant = g_hist.index(max(g_hist))
-        b_dominant = b_hist.index(max(b_hist))
-        
-        # Вычисляем средний цвет
-        stat = ImageStat.Stat(img)
-        mean_color = [int(x) for x in stat.mean]
-        
-        # Определяем цветовую температуру
-        warmth = (mean_color[0] - mean_color[2]) / 255.0
-        if warmth > 0.1:
-            color_temp = "теплое"
-        elif warmth < -0.1:
-            color_temp = "холодное"
-        else:
-            color_temp = "нейтральное"
-        
-        # Определяем яркость
-        brightness = sum(mean_color) / 3 / 255.0
-        if brightness < 0.3:
-            brightness_level = "темное"
-        elif brightness < 0.7:
-            brightness_level = "среднее"
-        else:
-            brightness_level = "светлое"
-        
-        return {
-            'dominant_rgb': (r_dominant, g_dominant, b_dominant),
-            'mean_rgb': tuple(mean_color),
-            'color_temperature': color_temp,
-            'brightness': brightness_level,
-            'warmth_index': warmth
-        }
+        thread = threading.Thread(target=run, name='lease_heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            thread.join()
+    
+    def complete(self, source, owner):
+        """Отмечает задание выполненным; False, если аренду уже забрал другой воркер"""
+        cursor = self.conn.execute(
+            "UPDATE jobs SET status = 'done', error = NULL, finished = ?, lease_expires = NULL"
+            " WHERE source = ? AND lease_owner = ? AND status = 'leased'",
+            (time.time(), source, owner))
+        return cursor.rowcount == 1
+    
+    def fail(self, source, owner, error):
+        """Ошибка задания: снова в очередь или окончательно failed после max_attempts"""
+        cursor = self.conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+            " error = ?, lease_expires = NULL"
+            " WHERE source = ? AND lease_owner = ? AND status = 'leased'",
+            (self.max_attempts, error, source, owner))
+        return cursor.rowcount == 1
+    
+    def active_leases(self):
+        """Сколько заданий сейчас в действующей аренде у кого-либо"""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'leased' AND lease_expires >= ?",
+            (time.time(),)).fetchone()[0]
+    
+    def counts(self):
+        """Число заданий по статусам"""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+    
+    def results(self):
+        """Итог по каждому заданию (а не только успех/неуспех)"""
+        return [{'file': source, 'output': output, 'status': status, 'ok': status == 'done',
+                 'attempts': attempts, 'worker': owner, 'error': error}
+                for source, output, status, attempts, owner, error in self.conn.execute(
+                    "SELECT source, output, status, attempts, lease_owner, error"
+                    " FROM jobs ORDER BY source")]
 
-def smart_processing(image_path, output_path):
+def queue_batch_processor(input_folder, output_folder, queue_dir, shard_index=0, shard_count=1,
+                          worker_name=None, max_workers=4, backend='thread',
+                          lease_seconds=WORK_LEASE_SECONDS, max_attempts=WORK_MAX_ATTEMPTS):
     """
-    Автоматически определяет тип изображения и применяет оптимальную обработку:
-    - ПОРТРЕТ: легкое размытие фона, коррекция кожи
-    - ПЕЙЗАЖ: усиление насыщенности, контраста  
-    - ТЕКСТ: повышение резкости, конвертация в ч/б
-    - НОЧНОЕ: шумоподавление, коррекция экспозиции
+    Возобновляемая пакетная обработка через очередь в queue_dir (общей ФС).
+    Дерево input_folder делится на shard_count шардов по хешу пути; этот
+    воркер ставит в очередь и обрабатывает шард shard_index. Несколько
+    воркеров одного шарда делят его через аренды, без координатора.
+    Воркер выходит, когда в шарде не осталось ни свободных заданий, ни
+    чужих действующих аренд (брошенные аренды он дожидается и забирает).
+    Результаты повторяют структуру папок входа: <папка>/fast_<имя>.
+    В очереди хранятся только пути относительно input_folder и output_folder
+    (через '/'): каждый воркер достраивает их от своих точек монтирования.
     """
-    with Image.open(image_path) as img:
-        analysis = analyze_dominant_color(image_path)
-        img_working = img.copy()
-        
-        # Эвристики для классификации
-        r, g, b = analysis['mean_rgb']
-        
-        # Определяем тип изображения
-        image_type = "unknown"
-        
-        # Эвристика для портрета: много телесных оттенков
-        skin_tone_ratio = (r / max(g, 1))
-        if 0.8 < skin_tone_ratio < 1.4 and r > 100 and g > 70 and b > 50:
-            image_type = "portrait"
-        
-        # Эвристика для пейзажа: много зеленого или синего
-        elif g > r and g > b and g > 100:
-            image_type = "landscape"
-        
-        # Эвристика для ночного: низкая яркость, но с контрастом
-        elif analysis['brightness'] == "темное" and max(r, g, b) - min(r, g, b) > 50:
-            image_type = "night"
+    import socket
+    
+    worker_name = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+    os.makedirs(queue_dir, exist_ok=True)
+    
+    jobs = []
+    for path in iter_image_files(input_folder, recursive=True):
+        relative = os.path.relpath(path, input_folder).replace(os.sep, '/')
+        if shard_of(relative, shard_count) == shard_index:
+            folder, name = posixpath.split(relative)
+            jobs.append((relative, posixpath.join(folder, f"fast_{name}")))
+    
+    queue_path = shard_queue_path(queue_dir, shard_index, shard_count)
+    with WorkQueue(queue_path, lease_seconds, max_attempts) as work_queue:
+        added = work_queue.enqueue(jobs)
+        print(f"[{worker_name}] шард {shard_index + 1}/{shard_count}: "
+              f"новых заданий {added}, всего {len(jobs)}")
         
-        # Применяем соответствующую обработку
-        if image_type == "portrait":
-            # Легкое размытие фона и улучшение кожи
-            enhancer = ImageEnhance.Color(img_working)
-            img_working = enhancer.enhance(1.1)
-            enhancer = ImageEnhance.Contrast(img_working)
-            img_working = enhancer.enhance(1.05)
-            
-        elif image_type == "landscape":
-            # Усиление насыщенности и контраста
-            enhancer = ImageEnhance.Color(img_working)
-            img_working = enhancer.enhance(1.3)
-            enhancer = ImageEnhance.Contrast(img_working)
-            img_working = enhancer.enhance(1.2)
-            enhancer = ImageEnhance.Sharpness(img_working)
-            img_working = enhancer.enhance(1.5)
-            
-        elif image_type == "night":
-            # Шумоподавление и коррекция яркости
-            img_working = img_working.filter(ImageFilter.SMOOTH)
-            enhancer = ImageEnhance.Brightness(img_working)
-            img_working = enhancer.enhance(1.3)
-            
+        if resolve_backend(backend, len(jobs), max_workers) == 'process':
+            executor_context = contextlib.nullcontext(get_process_pool(max_workers))
         else:
-            # Стандартное улучшение
-            enhancer = ImageEnhance.Contrast(img_working)
-            img_working = enhancer.enhance(1.1)
+            executor_context = ThreadPoolExecutor(max_workers=max_workers)
+        processed = 0
+        with executor_context as executor:
+            while True:
+                claimed = work_queue.claim(worker_name, limit=max_workers * 4)
+                if not claimed:
+                    if not work_queue.active_leases():
+                        break
+                    time.sleep(WORK_POLL_SECONDS)
+                    continue
+                sources = [source for source, _ in claimed]
+                inputs = [os.path.join(input_folder, *source.split('/')) for source in sources]
+                outputs = [os.path.join(output_folder, *output.split('/')) for _, output in claimed]
+                for output in set(map(os.path.dirname, outputs)):
+                    os.makedirs(output, exist_ok=True)
+                with work_queue.heartbeat(sources, worker_name):
+                    for source, result in zip(sources, executor.map(process_single_file,
+                                                                    inputs, outputs)):
+                        if result['ok']:
+                            recorded = work_queue.complete(source, worker_name)
+                        else:
+                            recorded = work_queue.fail(source, worker_name, result['error'])
+                        if not recorded:
+                            print(f"[{worker_name}] аренду {source} забрал другой воркер, "
+                                  f"результат не записан в очередь")
+                        processed += 1
         
-        img_working.save(output_path)
-        print(f"Обработано как {image_type}: {output_path}")
-        return image_type
+        counts = work_queue.counts()
+        results = work_queue.results()
+    print(f"[{worker_name}] обработано этим воркером: {processed}, статусы шарда: {counts}")
+    return {'shard': shard_index, 'processed': processed, 'counts': counts, 'results': results}
 
-def demo_smart_processing():
-    """Демонстрация умной обработки"""
-    print("\n=== УМНАЯ ОБРАБОТКА ===")
+def run_local_queue_workers(input_folder, output_folder, queue_dir, processes=4, shard_count=2,
+                            lease_seconds=30, kill_after=None):
+    """
+    Проверка очереди на одной машине: processes процессов CLI (команда
+    queue) по кругу делят shard_count шардов. kill_after - через сколько
+    секунд убить первый процесс: его аренды должны забрать остальные.
+    Возвращает статусы каждого шарда после завершения.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    workers = []
+    for index in range(processes):
+        command = [sys.executable, '-m', 'main', 'queue', input_folder, output_folder, queue_dir,
+                   '--shard', str(index % shard_count), '--shards', str(shard_count),
+                   '--worker', f"local-{index}", '--lease-seconds', str(lease_seconds),
+                   '--workers', '2']
+        workers.append(subprocess.Popen(command, cwd=folder, stdout=subprocess.DEVNULL))
+    if kill_after is not None:
+        time.sleep(kill_after)
+        workers[0].kill()
+        print(f"Воркер local-0 остановлен через {kill_after} с")
+    for worker in workers:
+        worker.wait()
     
-    # Анализ доминирующего цвета
-    for i in range(1, 4):
-        input_path = f"./input/photo{i}.jpg"
-        if os.path.exists(input_path):
-            analysis = analyze_dominant_color(input_path)
-            print(f"Анализ photo{i}.jpg: {analysis}")
-            
-            # Умная обработка
-            output_path = f"./output/photo{i}_smart.jpg"
-            image_type = smart_processing(input_path, output_path)
-            print(f"Тип изображения: {image_type}")
+    counts = {}
+    for shard_index in range(shard_count):
+        with WorkQueue(shard_queue_path(queue_dir, shard_index, shard_count)) as work_queue:
+            counts[shard_index] = work_queue.counts()
+    print(f"Статусы шардов: {counts}")
+    return counts
 
-# =============================================================================
-# ЧАСТЬ 4: ПАКЕТНАЯ ОБРАБОТКА И ОПТИМИЗАЦИЯ (Часть 3 РПО)
-# =============================================================================
+# Сигнал конца потока между стадиями конвейера
+_PIPELINE_DONE = object()
 
-def apply_complex_filters(img):
-    """Имитация сложной обработки для тестирования производительности"""
-    # Несколько операций для демонстрации
-    result = img.copy()
-    result = result.filter(ImageFilter.SHARPEN)
-    result = result.filter(ImageFilter.SMOOTH)
-    enhancer = ImageEnhance.Contrast(result)
-    result = enhancer.enhance(1.2)
-    enhancer = ImageEnhance.Color(result)
-    result = enhancer.enhance(1.1)
-    return result
+def _pipeline_put(q, item, stop_event):
+    """Кладет элемент в ограниченную очередь; ждет место (backpressure), пока не остановлены"""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
-def slow_batch_processor(input_folder, output_folder):
-    """Медленная версия обработки (для сравнения)"""
-    print("Запуск медленной обработки...")
+def _pipeline_stage(worker, in_queue, out_queue, stop_event, workers_left, steps=()):
+    """
+    Общий цикл стадии: берет элемент, обрабатывает, передает дальше.
+    steps - имена шагов timed_stage этой стадии: в item['stage_workers']
+    они записываются за текущим потоком.
+    """
+    while not stop_event.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _PIPELINE_DONE:
+            # Возвращаем сигнал для соседних потоков этой же стадии
+            in_queue.put(_PIPELINE_DONE)
+            break
+        # Ожидание во входной очереди и время шагов относятся к потоку этой стадии
+        current = worker_id()
+        wait_stage = f"queue_wait_{worker.__name__}"
+        if item['timings'] is not None:
+            item['timings'][wait_stage] = time.perf_counter() - item['enqueued_at']
+        item['stage_workers'][wait_stage] = current
+        item['enqueued_at'] = time.perf_counter()
+        if item.get('error') is None:
+            try:
+                for step in steps:
+                    item['stage_workers'][step] = current
+                worker(item)
+            except Exception as e:
+                item['error'] = str(e)
+                item['image'] = None
+        if not _pipeline_put(out_queue, item, stop_event):
+            return
+    # Последний поток стадии закрывает следующую очередь
+    with workers_left['lock']:
+        workers_left['count'] -= 1
+        if workers_left['count'] == 0:
+            _pipeline_put(out_queue, _PIPELINE_DONE, stop_event)
+
+def streaming_batch_processor(input_folder, output_folder, recursive=True,
+                              queue_size=8, decode_workers=2, transform_workers=2,
+                              encode_workers=2, metrics=None):
+    """
+    Потоковая обработка с ограниченной памятью (генератор).
+    Стадии обход -> декодирование -> фильтры -> кодирование соединены
+    очередями длины queue_size: если запись отстает, чтение ждет.
+    В памяти одновременно не больше ~3*queue_size изображений, первый
+    результат появляется сразу после обработки первого файла.
+    Отдает словари {'file', 'output', 'ok', 'error'} по мере готовности.
+    metrics: StageMetrics, включая время ожидания во входной очереди каждой
+    стадии (queue_wait_<стадия>); время и байты учитываются за потоком той
+    стадии, которая их потратила (stage_workers).
+    """
     os.makedirs(output_folder, exist_ok=True)
+    stop_event = threading.Event()
     
-    processed_count = 0
-    for filename in os.listdir(input_folder):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            input_path = os.path.join(input_folder, filename)
-            output_path = os.path.join(output_folder, f"slow_{filename}")
-            
-            with Image.open(input_path) as img:
-                result = apply_complex_filters(img)
-                result.save(output_path)
-            
-            processed_count += 1
-            print(f"Медленная обработка: {filename}")
+    path_queue = queue.Queue(maxsize=queue_size)
+    decoded_queue = queue.Queue(maxsize=queue_size)
+    filtered_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
     
-    print(f"Медленная обработка завершена: {processed_count} файлов")
-
-def optimized_batch_processor(input_folder, output_folder, max_workers=4):
-    """Оптимизированная многопоточная версия"""
-    print("Запуск оптимизированной обработки...")
+    def walk():
+        for input_path in iter_image_files(input_folder, recursive=recursive):
+            relative = os.path.relpath(input_path, input_folder)
+            folder, filename = os.path.split(relative)
+            item = {
+                'file': relative,
+                'input': input_path,
+                'output': os.path.join(output_folder, folder, f"fast_{filename}"),
+                'image': None,
+                'error': None,
+                'timings': {} if metrics is not None and metrics.should_sample() else None,
+                'stage_workers': {},
+                'enqueued_at': time.perf_counter()
+            }
+            if not _pipeline_put(path_queue, item, stop_event):
+                return
+        _pipeline_put(path_queue, _PIPELINE_DONE, stop_event)
     
-    # Создаем выходную папку если нет
+    def decode(item):
+        timings = item['timings']
+        with timed_stage(timings, 'open'):
+            data = LocalFiles.read(item['input'])
+        item['bytes_read'] = len(data)
+        with timed_stage(timings, 'decode'):
+            img = Image.open(io.BytesIO(data))
+            img.load()
+        with timed_stage(timings, 'convert'):
+            item['image'] = img.convert('RGB') if img.mode != 'RGB' else img
+    
+    def transform(item):
+        with timed_stage(item['timings'], 'filter'):
+            item['image'] = apply_complex_filters(item['image'])
+    
+    def encode(item):
+        timings = item['timings']
+        with timed_stage(timings, 'encode'):
+            buffer = encode_image(item['image'],
+                                  output_format(item['output'], FAST_SAVE_PARAMS['format']))
+        item['image'] = None
+        with timed_stage(timings, 'write'):
+            os.makedirs(os.path.dirname(item['output']), exist_ok=True)
+            LocalFiles.write(item['output'], buffer.getbuffer())
+        item['bytes_written'] = buffer.tell()
+    
+    stages = [
+        (decode, path_queue, decoded_queue, decode_workers, ('open', 'decode', 'convert')),
+        (transform, decoded_queue, filtered_queue, transform_workers, ('filter',)),
+        (encode, filtered_queue, result_queue, encode_workers, ('encode', 'write'))
+    ]
+    threads = [threading.Thread(target=walk, name='walk', daemon=True)]
+    for worker, in_queue, out_queue, count, steps in stages:
+        workers_left = {'count': count, 'lock': threading.Lock()}
+        for index in range(count):
+            threads.append(threading.Thread(
+                target=_pipeline_stage, name=f"{worker.__name__}_{index}",
+                args=(worker, in_queue, out_queue, stop_event, workers_left, steps),
+                daemon=True))
+    for thread in threads:
+        thread.start()
+    
+    try:
+        while True:
+            item = result_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+            item.pop('image', None)
+            item.pop('input', None)
+            item.pop('enqueued_at', None)
+            item['ok'] = item['error'] is None
+            if metrics is not None:
+                metrics.record_result(item)
+            yield item
+    finally:
+        # Генератор могли бросить на середине: останавливаем все стадии
+        stop_event.set()
+
+async def _async_process_file(input_path, output_path, files, io_limit, io_executor,
+                              cpu_executor, timed):
+    """Один файл: асинхронное чтение -> CPU в пуле -> асинхронная запись"""
+    loop = asyncio.get_running_loop()
+    filename = os.path.basename(input_path)
+    timings = {} if timed else None
+    try:
+        start_time = time.perf_counter()
+        async with io_limit:
+            data = await loop.run_in_executor(io_executor, files.read, input_path)
+        if timings is not None:
+            timings['open'] = time.perf_counter() - start_time
+        
+        encoded, cpu_timings, worker = await loop.run_in_executor(
+            cpu_executor, _transform_task, data, timed,
+            output_format(output_path, FAST_SAVE_PARAMS['format']))
+        if timings is not None:
+            timings.update(cpu_timings)
+        
+        start_time = time.perf_counter()
+        async with io_limit:
+            await loop.run_in_executor(io_executor, files.write, output_path, encoded)
+        if timings is not None:
+            timings['write'] = time.perf_counter() - start_time
+        
+        return {'file': filename, 'output': output_path, 'ok': True, 'error': None,
+                'timings': timings, 'bytes_read': len(data),
+                'bytes_written': len(encoded), 'worker': worker}
+    except Exception as e:
+        return {'file': filename, 'output': output_path, 'ok': False, 'error': str(e),
+                'timings': timings}
+
+async def async_batch_processor_async(input_folder, output_folder, io_concurrency=16,
+                                      cpu_workers=4, cpu_backend='process', files=None,
+                                      metrics=None):
+    """
+    Асинхронный вариант пакетной обработки для сетевых ФС.
+    - чтение и запись идут в отдельном пуле, одновременно не больше io_concurrency
+    - декодирование, фильтры и кодирование - в CPU-пуле на cpu_workers
+    - в работе не больше io_concurrency + 2 * cpu_workers файлов, так что
+      предвыборка не разрастается, если CPU не успевает
+    files - объект с методами read(path) и write(path, data) (LocalFiles по умолчанию).
+    cpu_backend: 'process', 'thread' или 'auto' (см. resolve_backend).
+    """
+    files = files or LocalFiles
     os.makedirs(output_folder, exist_ok=True)
+    # auto выбирает по числу файлов; обход каталога дешевле самой обработки
+    file_count = sum(1 for _ in iter_image_files(input_folder)) if cpu_backend == 'auto' else 0
+    cpu_backend = resolve_backend(cpu_backend, file_count, cpu_workers)
     
-    # Собираем все файлы заранее (оптимизация I/O)
-    files = [f for f in os.listdir(input_folder) 
-             if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    io_limit = asyncio.Semaphore(io_concurrency)
+    in_flight = asyncio.Semaphore(io_concurrency + 2 * cpu_workers)
+    io_executor = ThreadPoolExecutor(max_workers=io_concurrency, thread_name_prefix='io')
+    if cpu_backend == 'process':
+        cpu_executor = get_process_pool(cpu_workers)
+    else:
+        cpu_executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix='cpu')
     
-    def process_single_file(filename):
-        try:
-            input_path = os.path.join(input_folder, filename)
-            output_path = os.path.join(output_folder, f"fast_{filename}")
-            
-            with Image.open(input_path) as img:
-                # Предварительная обработка и кэширование в памяти
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                result = apply_complex_filters(img)
-                # Оптимизированные настройки сохранения
-                result.save(output_path, "JPEG", quality=85, optimize=True)
-            
-            print(f"Быстрая обработка: {filename}")
-            return True
-            
-        except Exception as e:
-            print(f"Ошибка обработки {filename}: {e}")
-            return False
+    results = []
+    tasks = set()
     
-    # Используем ThreadPoolExecutor для параллельной обработки
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        results = list(executor.map(process_single_file, files))
+    def finished(task):
+        tasks.discard(task)
+        in_flight.release()
+        result = task.result()
+        if metrics is not None:
+            metrics.record_result(result)
+        if result['ok']:
+            print(f"Асинхронная обработка: {result['file']}")
+        else:
+            print(f"Ошибка обработки {result['file']}: {result['error']}")
+        results.append(result)
     
-    success_count = sum(results)
-    print(f"Оптимизированная обработка завершена: {success_count}/{len(files)} файлов")
+    try:
+        for input_path in iter_image_files(input_folder):
+            await in_flight.acquire()
+            output_path = os.path.join(output_folder, f"fast_{os.path.basename(input_path)}")
+            timed = metrics is not None and metrics.should_sample()
+            task = asyncio.create_task(_async_process_file(
+                input_path, output_path, files, io_limit, io_executor, cpu_executor, timed))
+            tasks.add(task)
+            task.add_done_callback(finished)
+        while tasks:
+            await asyncio.wait(set(tasks))
+    finally:
+        io_executor.shutdown(wait=False)
+        if cpu_backend != 'process':
+            cpu_executor.shutdown(wait=False)
+    return results
+
+def async_batch_processor(input_folder, output_folder, io_concurrency=16, cpu_workers=4,
+                          cpu_backend='process', files=None, metrics=None):
+    """Синхронная обертка над async_batch_processor_async; возвращает число успешных файлов"""
+    print("Запуск асинхронной обработки...")
+    results = asyncio.run(async_batch_processor_async(
+        input_folder, output_folder, io_concurrency, cpu_workers, cpu_backend, files, metrics))
+    success_count = sum(1 for r in results if r['ok'])
+    print(f"Асинхронная обработка завершена: {success_count}/{len(results)} файлов")
     return success_count
 
+def benchmark_async_io(input_folder, output_folder, read_latency=0.05, write_latency=0.05,
+                       io_concurrency=(1, 4, 16), cpu_workers=4):
+    """
+    Имитация NFS задержками DelayedFiles: потоки, которые сами ждут I/O
+    (как optimized_batch_processor), против асинхронного режима
+    с разной глубиной I/O при одинаковом числе CPU-воркеров
+    """
+    print("\n=== БЕНЧМАРК АСИНХРОННОГО I/O ===")
+    
+    files = DelayedFiles(read_latency, write_latency)
+    paths = list(iter_image_files(input_folder))
+    os.makedirs(output_folder, exist_ok=True)
+    
+    def blocking(path):
+        data = files.read(path)
+        output_path = os.path.join(output_folder, f"fast_{os.path.basename(path)}")
+        files.write(output_path, transform_image_bytes(
+            data, fmt=output_format(output_path, FAST_SAVE_PARAMS['format'])))
+    
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=cpu_workers) as executor:
+            list(executor.map(blocking, paths))
+        results = {'threads': time.perf_counter() - start_time}
+        
+        get_process_pool(cpu_workers)
+        for depth in io_concurrency:
+            start_time = time.perf_counter()
+            async_batch_processor(input_folder, output_folder, io_concurrency=depth,
+                                  cpu_workers=cpu_workers, files=files)
+            results[f"async_io{depth}"] = time.perf_counter() - start_time
+    
+    print(f"Файлов: {len(paths)}, задержка чтения {read_latency*1000:.0f} мс, "
+          f"записи {write_latency*1000:.0f} мс, CPU-воркеров {cpu_workers}")
+    for name, seconds in results.items():
+        print(f"{name:<12} {seconds:6.2f} с  ({len(paths)/seconds:6.1f} файлов/с)")
+    return results
+
 def demo_optimization():
     """Демонстрация оптимизации производительности"""
     print("\n=== ОПТИМИЗАЦИЯ ПРОИЗВОДИТЕЛЬНОСТИ ===")
     
-    import time
-    
     # Тестируем медленную версию
     start_time = time.time()
     slow_batch_processor("./input", "./output/slow_results")
@@ -399,49 +3369,106 @@ def demo_optimization():
 # ЧАСТЬ 5: ГЕНЕРАТИВНАЯ ГРАФИКА И ВОДЯНЫЕ ЗНАКИ
 # =============================================================================
 
-def create_generative_art(width=800, height=600, filename="./output/generative_art.png"):
-    """Создает генеративное абстрактное изображение"""
-    # Создаем новое изображение
-    img = Image.new('RGB', (width, height), color='white')
+def generative_shapes(width, height, seed=None, circles=50, lines=10,
+                      radius_range=(10, 100)):
+    """
+    Параметры фигур из собственного генератора: одинаковый seed - одинаковые фигуры,
+    глобальный random не используется (безопасно для параллельных вызовов).
+    Порядок как у ImageDraw-версии: сначала круги, поверх них линии.
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        'circles': {
+            'center': rng.integers(0, [width + 1, height + 1], size=(circles, 2)),
+            'radius': rng.integers(radius_range[0], radius_range[1] + 1, size=circles),
+            'color': rng.integers(0, 256, size=(circles, 3), dtype=np.uint8)
+        },
+        'lines': {
+            'points': rng.integers(0, [width + 1, height + 1, width + 1, height + 1],
+                                   size=(lines, 4)),
+            'color': rng.integers(0, 256, size=(lines, 3), dtype=np.uint8)
+        }
+    }
+
+def draw_generative_shapes(width, height, shapes, line_width=3, background='white'):
+    """Рисует фигуры generative_shapes через ImageDraw: сначала круги, поверх линии"""
+    img = Image.new('RGB', (width, height), color=background)
     draw = ImageDraw.Draw(img)
-    
-    # Генерируем 50 случайных кругов
-    for _ in range(50):
-        # Случайные параметры круга
-        x = random.randint(0, width)
-        y = random.randint(0, height)
-        radius = random.randint(10, 100)
-        
-        # Случайный цвет с прозрачностью
-        color = (
-            random.randint(0, 255),
-            random.randint(0, 255), 
-            random.randint(0, 255)
-        )
-        
-        # Рисуем круг
-        draw.ellipse(
-            [x-radius, y-radius, x+radius, y+radius],
-            fill=color,
-            outline=None
-        )
-    
-    # Добавляем несколько линий для структуры
-    for _ in range(10):
-        x1, y1 = random.randint(0, width), random.randint(0, height)
-        x2, y2 = random.randint(0, width), random.randint(0, height)
-        
-        line_color = (
-            random.randint(0, 255),
-            random.randint(0, 255),
-            random.randint(0, 255)
-        )
-        
-        draw.line([x1, y1, x2, y2], fill=line_color, width=3)
+    circles = shapes['circles']
+    for (x, y), radius, color in zip(circles['center'].tolist(), circles['radius'].tolist(),
+                                     circles['color'].tolist()):
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=tuple(color))
+    for line, color in zip(shapes['lines']['points'].tolist(), shapes['lines']['color'].tolist()):
+        draw.line(line, fill=tuple(color), width=line_width)
+    return img
+
+def create_generative_art(width=800, height=600, filename="./output/generative_art.png",
+                          seed=None, circles=50, lines=10):
+    """Создает генеративное абстрактное изображение (одинаковый seed - одинаковый результат)"""
+    img = draw_generative_shapes(width, height,
+                                 generative_shapes(width, height, seed, circles, lines))
     
     # Сохраняем результат
-    img.save(filename, "PNG")
+    save_image(img, filename)
     print(f"Генеративное искусство сохранено как {filename}")
+    return filename
+
+def _generative_art_task(index, seed, output_folder, width, height, circles, lines):
+    """Одно изображение серии: seed изображения = (seed серии, номер)"""
+    filename = os.path.join(output_folder, f"art_{seed}_{index:05d}.png")
+    img = draw_generative_shapes(width, height,
+                                 generative_shapes(width, height, [seed, index], circles, lines))
+    save_image(img, filename)
+    return filename
+
+def generate_art_batch(count, output_folder, seed=0, width=800, height=600, circles=50,
+                       lines=10, max_workers=4, backend='auto'):
+    """
+    Серия из count изображений в пуле процессов. Результат не зависит от числа
+    воркеров и порядка выполнения: у каждого изображения свой генератор.
+    """
+    print(f"Генерация {count} изображений (seed={seed})...")
+    os.makedirs(output_folder, exist_ok=True)
+    args = [(index, seed, output_folder, width, height, circles, lines) for index in range(count)]
+    if resolve_backend(backend, count, max_workers) == 'process':
+        executor = get_process_pool(max_workers)
+        files = list(executor.map(_generative_art_task, *zip(*args),
+                                  chunksize=choose_chunksize(count, max_workers)))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            files = list(executor.map(_generative_art_task, *zip(*args)))
+    print(f"Сгенерировано: {len(files)} изображений в {output_folder}")
+    return files
+
+def benchmark_generative_art(shape_counts=(60, 1000, 10000, 100000), size=(800, 600),
+                             repeat=3, seed=42, batch_count=16, max_workers=4,
+                             work_dir="./output/bench_generative"):
+    """
+    Время одного изображения ImageDraw по числу фигур (линий - 1/6) и серия
+    из batch_count изображений: пул потоков против пула процессов
+    """
+    print("\n=== БЕНЧМАРК ГЕНЕРАТИВНОЙ ГРАФИКИ ===")
+    
+    results = {'single': [], 'batch': {}}
+    for count in shape_counts:
+        lines = count // 6
+        shapes = generative_shapes(size[0], size[1], seed, count - lines, lines)
+        best = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            draw_generative_shapes(size[0], size[1], shapes)
+            best = min(best, time.perf_counter() - start_time)
+        results['single'].append({'shapes': count, 'seconds': best})
+        print(f"{count:>7} фигур: {best:.3f} с")
+    
+    for backend in ('thread', 'process'):
+        start_time = time.perf_counter()
+        generate_art_batch(batch_count, os.path.join(work_dir, backend), seed, size[0], size[1],
+                           max_workers=max_workers, backend=backend)
+        seconds = time.perf_counter() - start_time
+        results['batch'][backend] = batch_count / seconds
+        print(f"Серия {batch_count} изображений, {backend}: {batch_count / seconds:.1f} изобр./с")
+    return results
 
 def generate_personal_watermark(user_id, username, size=(200, 100)):
     """
@@ -493,11 +3520,8 @@ def generate_personal_watermark(user_id, username, size=(200, 100)):
                             (i+pattern_size-3, j+pattern_size-3)], 
                            fill=color)
     
-    # Добавляем текст инициалов
-    try:
-        font = ImageFont.truetype("arial.ttf", 24)
-    except:
-        font = ImageFont.load_default()
+    # Добавляем текст инициалов (шрифт загружается один раз на процесс)
+    font = load_font(24)
     
     # Позиционируем текст
     bbox = draw.textbbox((0, 0), initials, font=font)
@@ -529,39 +3553,235 @@ def generate_personal_watermark(user_id, username, size=(200, 100)):
     
     return watermark
 
+@functools.lru_cache(maxsize=None)
+def load_font(size, name="arial.ttf"):
+    """Шрифт нужного размера; загружается один раз на процесс"""
+    try:
+        return ImageFont.truetype(name, size)
+    except OSError:
+        return ImageFont.load_default()
+
+def scale_watermark(watermark, width, opacity=1.0):
+    """Масштабирует водяной знак до ширины width и умножает альфу на opacity"""
+    height = max(1, watermark.height * width // watermark.width)
+    watermark = watermark.resize((width, height), Image.Resampling.LANCZOS)
+    if opacity < 1.0:
+        alpha = watermark.getchannel('A').point(lambda a: int(a * opacity))
+        watermark.putalpha(alpha)
+    return watermark
+
+def watermark_position(base_size, watermark_size, position='bottom-right'):
+    """Координаты левого верхнего угла водяного знака"""
+    if position == 'bottom-right':
+        return (base_size[0] - watermark_size[0] - 10, base_size[1] - watermark_size[1] - 10)
+    elif position == 'center':
+        return ((base_size[0] - watermark_size[0]) // 2, (base_size[1] - watermark_size[1]) // 2)
+    else:  # top-left
+        return (10, 10)
+
 def apply_advanced_watermark(base_image, watermark, position='bottom-right', opacity=0.7):
     """Применяет водяной знак к изображению"""
     # Масштабируем водяной знак пропорционально основному изображению
-    wm_width = base_image.width // 4
-    wm_height = watermark.height * wm_width // watermark.width
-    watermark = watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
+    watermark = scale_watermark(watermark, base_image.width // 4, opacity)
     
     # Создаем копию основного изображения
     result = base_image.copy().convert('RGBA')
     
-    # Позиционируем водяной знак
-    if position == 'bottom-right':
-        x = result.width - watermark.width - 10
-        y = result.height - watermark.height - 10
-    elif position == 'center':
-        x = (result.width - watermark.width) // 2
-        y = (result.height - watermark.height) // 2
-    else:  # top-left
-        x = 10
-        y = 10
-    
     # Накладываем водяной знак
-    result.alpha_composite(watermark, (x, y))
+    result.alpha_composite(watermark, watermark_position(result.size, watermark.size, position))
+    
+    return result.convert('RGB')
+
+class WatermarkCache:
+    """
+    LRU-кэш готовых водяных знаков по (user_id, username, ширина, opacity).
+    Хранит RGBA-знаки (get) или только их предумноженный вид
+    (get_premultiplied) - каждый под своим ключом. Размер ограничен
+    max_bytes, считает попадания, промахи и вытеснения. Один экземпляр на процесс.
+    """
+    
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id, username, width, opacity=1.0):
+        """Возвращает готовый водяной знак; строит его только при промахе"""
+        return self._get((user_id, username, width, opacity, False), lambda: scale_watermark(
+            generate_personal_watermark(user_id, username), width, opacity))
+    
+    def get_premultiplied(self, user_id, username, width, opacity=1.0):
+        """Водяной знак в виде (RGB * alpha, 255 - alpha) для composite_premultiplied"""
+        # RGBA-знак строится на месте и не кэшируется: он нужен только здесь
+        return self._get((user_id, username, width, opacity, True), lambda: premultiply_watermark(
+            scale_watermark(generate_personal_watermark(user_id, username), width, opacity)))
+    
+    def _get(self, key, build):
+        with self._lock:
+            entry = self._tiles.get(key)
+            if entry is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        
+        value = build()
+        images = value if isinstance(value, tuple) else (value,)
+        size = sum(len(img.getbands()) * img.width * img.height for img in images)
+        with self._lock:
+            if key not in self._tiles and size <= self.max_bytes:
+                self._tiles[key] = (value, size)
+                self.current_bytes += size
+                while self.current_bytes > self.max_bytes:
+                    _, (_, old_size) = self._tiles.popitem(last=False)
+                    self.current_bytes -= old_size
+                    self.evictions += 1
+        return value
+    
+    def stats(self):
+        """Счетчики кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._tiles),
+                'bytes': self.current_bytes,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+    
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.current_bytes = 0
+
+# Кэш водяных знаков процесса
+WATERMARK_CACHE = WatermarkCache()
+
+def apply_user_watermark(base_image, user_id, username, position='bottom-right',
+                         opacity=0.7, cache=None):
+    """То же, что apply_advanced_watermark, но водяной знак берется из кэша"""
+    cache = cache or WATERMARK_CACHE
+    watermark = cache.get(user_id, username, base_image.width // 4, opacity)
     
+    result = base_image.copy().convert('RGBA')
+    result.alpha_composite(watermark, watermark_position(result.size, watermark.size, position))
     return result.convert('RGB')
 
+def premultiply_watermark(watermark):
+    """RGBA -> (RGB * alpha / 255, 255 - alpha): готово к наложению без RGBA-конвертаций"""
+    alpha = watermark.getchannel('A')
+    alpha_rgb = Image.merge('RGB', (alpha, alpha, alpha))
+    premultiplied = ImageChops.multiply(watermark.convert('RGB'), alpha_rgb)
+    return premultiplied, ImageChops.invert(alpha_rgb)
+
+def composite_premultiplied(base_image, premultiplied, inverse_alpha, xy):
+    """
+    Накладывает предумноженный знак на RGB изображение на месте:
+    обрабатывается только область под знаком, без копии кадра и без RGBA.
+    """
+    box = (xy[0], xy[1], xy[0] + premultiplied.width, xy[1] + premultiplied.height)
+    region = base_image.crop(box)
+    region = ImageChops.add(ImageChops.multiply(region, inverse_alpha), premultiplied)
+    base_image.paste(region, box)
+    return base_image
+
+def watermark_file(image_path, user_id, username, output_path,
+                   position='bottom-right', opacity=0.7):
+    """Ставит водяной знак на один файл и сразу пишет результат на диск"""
+    filename = os.path.basename(image_path)
+    try:
+        with Image.open(image_path) as img:
+            img = img.convert('RGB') if img.mode != 'RGB' else img
+            premultiplied, inverse_alpha = WATERMARK_CACHE.get_premultiplied(
+                user_id, username, img.width // 4, opacity)
+            composite_premultiplied(img, premultiplied, inverse_alpha,
+                                    watermark_position(img.size, premultiplied.size, position))
+            save_image(img, output_path)
+        return {'file': filename, 'output': output_path, 'ok': True, 'error': None}
+    except Exception as e:
+        return {'file': filename, 'output': output_path, 'ok': False, 'error': str(e)}
+
+def read_watermark_manifest(path):
+    """Читает CSV манифест: image_path,user_id,username (лениво, построчно)"""
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if len(row) >= 3 and not row[0].startswith('#'):
+                yield row[0], row[1], row[2]
+
+def bounded_map(executor, func, args_iter, max_in_flight):
+    """
+    Как executor.map, но берет задачи из итератора постепенно: в работе
+    не больше max_in_flight. Результаты отдаются по мере готовности.
+    """
+    pending = set()
+    for args in args_iter:
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(func, *args))
+    for future in as_completed(pending):
+        yield future.result()
+
+def batch_watermark(manifest, output_folder, max_workers=4, backend='process',
+                    position='bottom-right', opacity=0.7, return_results=False):
+    """
+    Пакетная расстановка водяных знаков.
+    manifest - путь к CSV (image_path,user_id,username) или итерируемое таких троек.
+    Манифест читается потоково, воркеры сами пишут файлы на диск; у каждого
+    процесса свой кэш водяных знаков, поэтому знак пользователя строится
+    один раз на воркер.
+    backend: 'thread', 'process' или 'auto' (см. resolve_backend); для auto
+    CSV сначала просматривается отдельным легким проходом, чтобы узнать число строк.
+    """
+    print("Запуск пакетной расстановки водяных знаков...")
+    os.makedirs(output_folder, exist_ok=True)
+    
+    file_count = 0
+    if backend == 'auto':
+        if isinstance(manifest, str):
+            file_count = sum(1 for _ in read_watermark_manifest(manifest))
+        else:
+            manifest = manifest if hasattr(manifest, '__len__') else list(manifest)
+            file_count = len(manifest)
+    backend = resolve_backend(backend, file_count, max_workers)
+    if isinstance(manifest, str):
+        manifest = read_watermark_manifest(manifest)
+    
+    def tasks():
+        for image_path, user_id, username in manifest:
+            output_path = os.path.join(output_folder,
+                                       f"wm_{user_id}_{os.path.basename(image_path)}")
+            yield image_path, user_id, username, output_path, position, opacity
+    
+    if backend == 'process':
+        executor = get_process_pool(max_workers)
+        results = _collect_batch_results(
+            bounded_map(executor, watermark_file, tasks(), max_workers * 4), "Водяной знак")
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = _collect_batch_results(
+                bounded_map(executor, watermark_file, tasks(), max_workers * 4), "Водяной знак")
+    
+    success_count = sum(1 for r in results if r['ok'])
+    print(f"Водяные знаки расставлены: {success_count}/{len(results)} файлов")
+    if return_results:
+        return results
+    return success_count
+
 def demo_generative_and_watermarks():
     """Демонстрация генеративной графики и водяных знаков"""
     print("\n=== ГЕНЕРАТИВНАЯ ГРАФИКА И ВОДЯНЫЕ ЗНАКИ ===")
     
     # Создаем генеративное искусство
     for i in range(2):
-        create_generative_art(filename=f"./output/generative_art_{i+1}.png")
+        create_generative_art(filename=f"./output/generative_art_{i+1}.png", seed=i)
     
     # Создаем водяные знаки для разных пользователей
     users = [
@@ -584,11 +3804,225 @@ def demo_generative_and_watermarks():
         print("Водяной знак применен к тестовому изображению")
 
 # =============================================================================
-# ГЛАВНАЯ ФУНКЦИЯ
+# ЧАСТЬ 6: БЕНЧМАРКИ И КОНТРОЛЬ РЕГРЕССИЙ
+# =============================================================================
+
+# Допустимое замедление относительно базовой линии (10%)
+BENCHMARK_TOLERANCE = 0.10
+
+def percentile(values, q):
+    """Перцентиль q (0..100) с линейной интерполяцией"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+def measure(func, warmup=1, repeat=5):
+    """Прогрев, затем repeat замеров; перцентили в секундах и пиковый RSS процесса"""
+    import resource
+    
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start_time)
+    return {
+        'samples': samples,
+        'min': min(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+def build_benchmark_inputs(work_dir, resolutions, corpus_sizes):
+    """
+    Синтетические входы: по одному фото на разрешение и папки-корпуса
+    разного размера (в первом разрешении). Уже созданные файлы переиспользуются.
+    """
+    inputs = {'images': {}, 'corpora': {}}
+    os.makedirs(work_dir, exist_ok=True)
+    for width, height in resolutions:
+        path = os.path.join(work_dir, f"photo_{width}x{height}.jpg")
+        if not os.path.exists(path):
+            base = create_gradient((width, height), [(0.0, (200, 150, 120)), (0.5, (90, 160, 70)),
+                                                     (1.0, (40, 60, 150))], kind='radial')
+            noise = Image.effect_noise((width, height), 40).convert('RGB')
+            Image.blend(base, noise, 0.2).save(path, quality=90)
+        inputs['images'][(width, height)] = path
+    
+    source = inputs['images'][tuple(resolutions[0])]
+    for count in corpus_sizes:
+        folder = os.path.join(work_dir, f"corpus_{count}")
+        os.makedirs(folder, exist_ok=True)
+        for i in range(count):
+            path = os.path.join(folder, f"img_{i:05d}.jpg")
+            if not os.path.exists(path):
+                with Image.open(source) as img:
+                    img.rotate(i % 360).save(path, quality=90)
+        inputs['corpora'][count] = folder
+    return inputs
+
+def _benchmark_callable(name, param, inputs, out_dir):
+    """Функция без аргументов для одного случая бенчмарка"""
+    if name == 'gradient':
+        return lambda: create_smart_gradient_fixed(param)
+    if name == 'gradient_radial':
+        return lambda: create_gradient(param, kind='radial')
+    if name == 'analysis':
+        return lambda: analyze_dominant_color(inputs['images'][param])
+    if name == 'smart_processing':
+        return lambda: smart_processing(inputs['images'][param], os.path.join(out_dir, "smart.jpg"))
+    if name == 'generative_art':
+        return lambda: create_generative_art(param[0], param[1], os.path.join(out_dir, "art.png"),
+                                             seed=0)
+    if name == 'watermark':
+        base = Image.open(inputs['images'][param]).convert('RGB')
+        return lambda: apply_advanced_watermark(base, generate_personal_watermark(1, "Bench User"))
+    if name == 'watermark_cached':
+        base = Image.open(inputs['images'][param]).convert('RGB')
+        return lambda: apply_user_watermark(base, 1, "Bench User")
+    if name == 'collage':
+        side = max(1, int(math.sqrt(param)))
+        return lambda: create_collage_from_folder_fixed(
+            inputs['corpora'][param], os.path.join(out_dir, "collage.jpg"), side, side)
+    if name == 'collage_engine':
+        return lambda: create_collage(inputs['corpora'][param],
+                                      os.path.join(out_dir, "collage_engine.jpg"),
+                                      layout='justified', width=1600)
+    if name == 'slow_batch':
+        return lambda: slow_batch_processor(inputs['corpora'][param], os.path.join(out_dir, "slow"))
+    if name == 'optimized_batch':
+        return lambda: optimized_batch_processor(inputs['corpora'][param],
+                                                 os.path.join(out_dir, "fast"))
+    raise ValueError(f"Неизвестный бенчмарк: {name}")
+
+# Случаи по разрешению и по размеру корпуса
+RESOLUTION_BENCHMARKS = ('gradient', 'gradient_radial', 'analysis', 'smart_processing',
+                         'generative_art', 'watermark', 'watermark_cached')
+CORPUS_BENCHMARKS = ('collage', 'collage_engine', 'slow_batch', 'optimized_batch')
+
+def _run_benchmark_case(name, param, inputs, out_dir, warmup, repeat):
+    """Один случай в отдельном процессе: пиковый RSS не смешивается с другими случаями"""
+    func = _benchmark_callable(name, param, inputs, out_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return measure(func, warmup, repeat)
+
+def run_benchmarks(output_json="./output/benchmarks.json", work_dir="./output/bench_inputs",
+                   resolutions=((800, 600), (1920, 1080)), corpus_sizes=(8, 32),
+                   warmup=1, repeat=5, only=None):
+    """
+    Прогоняет все горячие функции на синтетических входах и пишет JSON:
+    p50/p90/p99, min, mean и пиковый RSS для каждого случая.
+    only - список имен случаев, если нужны не все.
+    """
+    print("\n=== БЕНЧМАРКИ ===")
+    
+    import platform
+    import PIL
+    
+    inputs = build_benchmark_inputs(work_dir, resolutions, corpus_sizes)
+    out_dir = os.path.join(work_dir, "results")
+    os.makedirs(out_dir, exist_ok=True)
+    
+    cases = [(name, tuple(res), f"{name}[{res[0]}x{res[1]}]")
+             for name in RESOLUTION_BENCHMARKS for res in resolutions]
+    cases += [(name, count, f"{name}[n={count}]")
+              for name in CORPUS_BENCHMARKS for count in corpus_sizes]
+    if only:
+        cases = [case for case in cases if case[0] in only]
+    
+    results = {}
+    for name, param, key in cases:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            results[key] = executor.submit(_run_benchmark_case, name, param, inputs,
+                                           out_dir, warmup, repeat).result()
+        r = results[key]
+        print(f"{key:<36} p50 {r['p50']*1000:9.2f} мс  p90 {r['p90']*1000:9.2f} мс  "
+              f"RSS {r['peak_rss_kb']/1024:7.1f} МБ")
+    
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'cpu_count': os.cpu_count(),
+            'warmup': warmup,
+            'repeat': repeat
+        },
+        'results': results
+    }
+    os.makedirs(os.path.dirname(output_json) or '.', exist_ok=True)
+    with open(output_json, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output_json}")
+    return report
+
+def compare_benchmarks(current, baseline, tolerance=BENCHMARK_TOLERANCE, metric='p50',
+                       only=None):
+    """
+    Сравнивает отчеты (словари или пути к JSON) по метрике metric.
+    Возвращает список регрессий: случаи, ставшие медленнее больше чем на tolerance,
+    и случаи базовой линии, которых нет в текущем прогоне (missing) - пропавший
+    замер не должен проходить проверку молча. only - имена случаев, как в
+    run_benchmarks: остальные случаи базовой линии не проверяются.
+    """
+    if isinstance(current, str):
+        with open(current, encoding='utf-8') as f:
+            current = json.load(f)
+    if isinstance(baseline, str):
+        with open(baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    
+    regressions = []
+    for key, base in baseline['results'].items():
+        if only and key.split('[')[0] not in only:
+            continue
+        now = current['results'].get(key)
+        if now is None:
+            regressions.append({'case': key, 'baseline': base[metric], 'current': None,
+                                'ratio': None, 'missing': True})
+            print(f"{key:<36} {base[metric]*1000:9.2f} ->       нет замера ОТСУТСТВУЕТ")
+            continue
+        ratio = now[metric] / base[metric] if base[metric] else 1.0
+        status = "OK"
+        if ratio > 1 + tolerance:
+            status = "РЕГРЕССИЯ"
+            regressions.append({'case': key, 'baseline': base[metric],
+                                'current': now[metric], 'ratio': ratio})
+        print(f"{key:<36} {base[metric]*1000:9.2f} -> {now[metric]*1000:9.2f} мс "
+              f"({ratio:5.2f}x) {status}")
+    return regressions
+
+def check_benchmarks(baseline_path, tolerance=BENCHMARK_TOLERANCE, metric='p50', **kwargs):
+    """Режим сравнения: прогон и выход с кодом 1, если есть регрессии"""
+    report = run_benchmarks(**kwargs)
+    print("\n=== СРАВНЕНИЕ С БАЗОВОЙ ЛИНИЕЙ ===")
+    regressions = compare_benchmarks(report, baseline_path, tolerance, metric,
+                                     kwargs.get('only'))
+    if regressions:
+        slower = [r['case'] for r in regressions if not r.get('missing')]
+        missing = [r['case'] for r in regressions if r.get('missing')]
+        if slower:
+            print(f"❌ Замедлились: {', '.join(slower)}")
+        if missing:
+            print(f"❌ Нет замеров: {', '.join(missing)}")
+        raise SystemExit(1)
+    print("✅ Регрессий нет")
+    return report
+
+# =============================================================================
+# ГЛАВНАЯ ФУНКЦИЯ И КОМАНДНАЯ СТРОКА
 # =============================================================================
 
-def main():
-    """Главная функция, запускающая все демонстрации"""
+def run_demos():
+    """Запускает все демонстрации по порядку"""
     print("🚀 ЗАПУСК АВТОМАТИЗАЦИИ ОБРАБОТКИ ИЗОБРАЖЕНИЙ")
     print("=" * 50)
     
@@ -621,5 +4055,323 @@ def main():
         import traceback
         traceback.print_exc()
 
+def _parse_size(value):
+    """'800x600' -> (800, 600)"""
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Размер должен быть вида ШИРИНАxВЫСОТА: {value}")
+    return width, height
+
+def _cli_batch(args):
+    if args.mode == 'smart':
+        summary = smart_batch_processor(args.input, args.output, args.workers, args.backend,
+                                        args.recursive)
+        return {key: value for key, value in summary.items() if key != 'results'}
+    if args.mode == 'streaming':
+        # Генератор ничего не делает, пока его не читают
+        results = _collect_batch_results(
+            streaming_batch_processor(args.input, args.output, args.recursive),
+            label="Потоковая обработка")
+        success_count = sum(1 for r in results if r['ok'])
+        print(f"Потоковая обработка завершена: {success_count}/{len(results)} файлов")
+        return {'ok': success_count, 'errors': len(results) - success_count}
+    if args.mode == 'async':
+        return async_batch_processor(args.input, args.output, cpu_workers=args.workers,
+                                     cpu_backend=args.backend)
+    return optimized_batch_processor(args.input, args.output, args.workers, args.backend,
+                                     manifest_path=args.manifest, dedupe=args.dedupe,
+                                     hash_index_path=args.hash_index)
+
+def _cli_watermark(args):
+    return batch_watermark(args.manifest, args.output, args.workers, args.backend,
+                           args.position, args.opacity)
+
+def _cli_analyze(args):
+    # Один декод на файл (JPEG сразу уменьшенный): из него и анализ цвета,
+    # и прокси классификатора; классы считаются одной векторной пачкой
+    side = max(args.proxy_size, CLASSIFIER_PROXY_SIZE)
+    results, proxies = {}, []
+    for path in args.paths:
+        img = load_analysis_image(path, side)
+        results[path] = analyze_image(img, args.proxy_size)
+        proxies.append(classifier_proxy(img))
+    for path, image_type in zip(args.paths, classify_proxies(proxies) if proxies else []):
+        results[path]['image_type'] = str(image_type)
+    print(json.dumps(results, ensure_ascii=False, indent=2, default=str))
+    return results
+
+def _cli_collage(args):
+    if args.deepzoom:
+        return create_deepzoom(args.folder, args.output, layout=args.layout, width=args.width,
+                               max_workers=args.workers, backend=args.backend,
+                               recursive=args.recursive, limit=args.limit)
+    return create_collage(args.folder, args.output, layout=args.layout, width=args.width,
+                          columns=args.columns, page_height=args.page_height,
+                          max_workers=args.workers, backend=args.backend,
+                          recursive=args.recursive, limit=args.limit, dedupe=args.dedupe,
+                          hash_index_path=args.hash_index)
+
+def _cli_gradient(args):
+    ImageColor = importlib.import_module('PIL.ImageColor')
+    colors = [ImageColor.getrgb(color) for color in args.colors]
+    stops = [(i / max(len(colors) - 1, 1), color) for i, color in enumerate(colors)]
+    img = create_gradient(args.size, stops, args.kind, args.angle)
+    save_image(img, args.output)
+    print(f"Градиент сохранен: {args.output}")
+    return args.output
+
+def _cli_generate(args):
+    return generate_art_batch(args.count, args.output, args.seed, args.size[0], args.size[1],
+                              args.circles, args.lines, args.workers, args.backend)
+
+def _cli_corpus(args):
+    return generate_test_corpus(args.folder, args.count, (args.min_size, args.max_size),
+                                seed=args.seed, max_workers=args.workers, backend=args.backend)
+
+def _cli_queue(args):
+    summary = queue_batch_processor(args.input, args.output, args.queue_dir, args.shard,
+                                    args.shards, args.worker, args.workers, args.backend,
+                                    args.lease_seconds, args.max_attempts)
+    return {key: value for key, value in summary.items() if key != 'results'}
+
+def _cli_demo(args):
+    run_demos()
+
+def _cli_serve(args):
+    serve(args.socket, args.warm_workers)
+
+def _cli_startup(args):
+    return benchmark_cold_start(args.repeat)
+
+def build_cli_parser():
+    """Парсер командной строки: по подкоманде на операцию"""
+    parser = argparse.ArgumentParser(
+        prog='main.py', description="Автоматизация обработки изображений. Без команды "
+        "запускаются все демонстрации. Для быстрого старта: python -m main <команда> "
+        "(байткод кэшируется, в отличие от python main.py).")
+    commands = parser.add_subparsers(dest='command')
+    
+    def pool_options(command):
+        command.add_argument('--workers', type=int, default=4, help="число воркеров")
+        command.add_argument('--backend', choices=('thread', 'process', 'auto'), default='auto')
+    
+    batch = commands.add_parser('batch', help="пакетная обработка папки")
+    batch.add_argument('input')
+    batch.add_argument('output')
+    batch.add_argument('--mode', choices=('optimized', 'streaming', 'async', 'smart'),
+                       default='optimized')
+    batch.add_argument('--manifest', help="SQLite-манифест инкрементального режима")
+    batch.add_argument('--dedupe', choices=DEDUPE_MODES, help="пропуск почти-дубликатов")
+    batch.add_argument('--hash-index', help="постоянный индекс перцептивных хешей")
+    batch.add_argument('--recursive', action='store_true')
+    pool_options(batch)
+    batch.set_defaults(handler=_cli_batch)
+    
+    watermark = commands.add_parser('watermark', help="водяные знаки по CSV-манифесту")
+    watermark.add_argument('manifest', help="CSV: image_path,user_id,username")
+    watermark.add_argument('output')
+    watermark.add_argument('--position', default='bottom-right')
+    watermark.add_argument('--opacity', type=float, default=0.7)
+    pool_options(watermark)
+    watermark.set_defaults(handler=_cli_watermark)
+    
+    analyze = commands.add_parser('analyze', help="анализ цвета и класс изображений (JSON)")
+    analyze.add_argument('paths', nargs='+')
+    analyze.add_argument('--proxy-size', type=int, default=128)
+    analyze.set_defaults(handler=_cli_analyze)
+    
+    collage = commands.add_parser('collage', help="коллаж или DeepZoom из папки")
+    collage.add_argument('folder')
+    collage.add_argument('output')
+    collage.add_argument('--layout', choices=COLLAGE_LAYOUTS, default='grid')
+    collage.add_argument('--width', type=int, default=1600)
+    collage.add_argument('--columns', type=int, default=6)
+    collage.add_argument('--page-height', type=int)
+    collage.add_argument('--limit', type=int)
+    collage.add_argument('--dedupe', action='store_true')
+    collage.add_argument('--hash-index')
+    collage.add_argument('--deepzoom', action='store_true', help="output - папка пирамиды")
+    collage.add_argument('--recursive', action='store_true')
+    pool_options(collage)
+    collage.set_defaults(handler=_cli_collage)
+    
+    gradient = commands.add_parser('gradient', help="градиент в файл")
+    gradient.add_argument('output')
+    gradient.add_argument('--size', type=_parse_size, default=(400, 400))
+    gradient.add_argument('--kind', choices=('linear', 'radial', 'angular'), default='linear')
+    gradient.add_argument('--angle', type=float, default=0.0)
+    gradient.add_argument('--colors', nargs='+', default=['red', 'blue'],
+                          help="опорные цвета через равные промежутки")
+    gradient.set_defaults(handler=_cli_gradient)
+    
+    generate = commands.add_parser('generate', help="серия генеративных изображений")
+    generate.add_argument('output')
+    generate.add_argument('--count', type=int, default=10)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.add_argument('--size', type=_parse_size, default=(800, 600))
+    generate.add_argument('--circles', type=int, default=50)
+    generate.add_argument('--lines', type=int, default=10)
+    pool_options(generate)
+    generate.set_defaults(handler=_cli_generate)
+    
+    corpus = commands.add_parser('corpus', help="синтетический тестовый корпус")
+    corpus.add_argument('folder')
+    corpus.add_argument('--count', type=int, default=1000)
+    corpus.add_argument('--seed', type=int, default=0)
+    corpus.add_argument('--min-size', type=_parse_size, default=(640, 480))
+    corpus.add_argument('--max-size', type=_parse_size, default=(1024, 768))
+    pool_options(corpus)
+    corpus.set_defaults(handler=_cli_corpus)
+    
+    work = commands.add_parser('queue', help="воркер возобновляемой очереди (шардирование)")
+    work.add_argument('input')
+    work.add_argument('output')
+    work.add_argument('queue_dir', help="папка очередей шардов (общая ФС)")
+    work.add_argument('--shard', type=int, default=0, help="номер шарда этого воркера")
+    work.add_argument('--shards', type=int, default=1, help="всего шардов")
+    work.add_argument('--worker', help="имя воркера (по умолчанию хост:pid)")
+    work.add_argument('--lease-seconds', type=float, default=WORK_LEASE_SECONDS)
+    work.add_argument('--max-attempts', type=int, default=WORK_MAX_ATTEMPTS)
+    pool_options(work)
+    work.set_defaults(handler=_cli_queue)
+    
+    demo = commands.add_parser('demo', help="все демонстрации (как без команды)")
+    demo.set_defaults(handler=_cli_demo)
+    
+    server = commands.add_parser('serve', help="долгоживущий режим: задания JSON-строками")
+    server.add_argument('--socket', help="Unix-сокет; без него задания читаются из stdin")
+    server.add_argument('--warm-workers', type=int, default=0,
+                        help="заранее запустить пул из N процессов")
+    server.set_defaults(handler=_cli_serve)
+    
+    startup = commands.add_parser('startup', help="замер холодного старта")
+    startup.add_argument('--repeat', type=int, default=10)
+    startup.set_defaults(handler=_cli_startup)
+    return parser
+
+def run_cli_command(argv):
+    """Разбирает argv и выполняет команду; возвращает ее результат"""
+    args = build_cli_parser().parse_args(argv)
+    if args.command is None:
+        return run_demos()
+    return args.handler(args)
+
+def run_job(line):
+    """
+    Одно задание сервера: JSON {"id": ..., "argv": [...]} или просто список
+    аргументов. Ответ - словарь с ok, result или error и временем выполнения.
+    """
+    start_time = time.perf_counter()
+    job_id = None
+    try:
+        job = json.loads(line)
+        if isinstance(job, dict):
+            job_id = job.get('id')
+            job = job['argv']
+        if job and job[0] == 'serve':
+            raise ValueError("Команда serve недоступна внутри сервера")
+        response = {'id': job_id, 'ok': True, 'result': run_cli_command(job)}
+    except SystemExit as e:
+        # argparse завершает процесс при ошибке разбора; серверу это не нужно
+        response = {'id': job_id, 'ok': False, 'error': f"Неверные аргументы (код {e.code})"}
+    except Exception as e:
+        response = {'id': job_id, 'ok': False, 'error': str(e)}
+    response['seconds'] = time.perf_counter() - start_time
+    return response
+
+def serve(socket_path=None, warm_workers=0):
+    """
+    Долгоживущий режим: импорты, пулы процессов и кэши остаются прогретыми
+    между заданиями. Задания - JSON-строки, ответ - JSON-строка на каждое.
+    Без socket_path задания читаются из stdin, ответы пишутся в stdout
+    (вывод самих команд уходит в stderr). С socket_path - Unix-сокет,
+    каждое соединение обслуживается в своем потоке.
+    """
+    if socket_path is None:
+        # Ответы идут в копию исходного stdout, а дескриптор 1 подменяется
+        # на stderr до создания пулов: print воркеров-процессов пишет прямо
+        # в унаследованный fd 1 и иначе ломал бы протокол
+        sys.stdout.flush()
+        responses = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+        os.dup2(2, 1)
+    
+    # Прогреваем тяжелые импорты и пул до первого задания
+    np.ndarray, Image.Image, ImageFilter.Kernel, ImageDraw.Draw
+    if warm_workers:
+        get_process_pool(warm_workers)
+    
+    if socket_path is None:
+        print("Сервер заданий: читаю stdin", file=sys.stderr)
+        for line in sys.stdin:
+            if line.strip():
+                response = run_job(line)
+                sys.stdout.flush()
+                responses.write(json.dumps(response, ensure_ascii=False, default=str) + "\n")
+                responses.flush()
+        return
+    
+    import signal
+    import socketserver
+    
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    response = run_job(line.decode('utf-8'))
+                    self.wfile.write((json.dumps(response, ensure_ascii=False, default=str)
+                                      + "\n").encode('utf-8'))
+    
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # SIGTERM от менеджера воркеров - такое же штатное завершение, как Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with socketserver.ThreadingUnixStreamServer(socket_path, JobHandler) as server:
+        print(f"Сервер заданий: {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+            shutdown_process_pools()
+
+def benchmark_cold_start(repeat=10):
+    """
+    Время холодного старта в отдельных процессах: голый интерпретатор,
+    импорт модуля, справка CLI через python main.py и python -m main
+    (второй путь берет байткод из кэша) и маленький градиент - команда,
+    которой нужны numpy и Pillow.
+    """
+    print("\n=== ХОЛОДНЫЙ СТАРТ ===")
+    
+    folder = os.path.dirname(os.path.abspath(__file__))
+    output = os.path.join(folder, "output", "startup_gradient.png")
+    cases = {
+        'python': [sys.executable, '-c', 'pass'],
+        'import': [sys.executable, '-c', 'import main'],
+        'script_help': [sys.executable, 'main.py', '--help'],
+        'module_help': [sys.executable, '-m', 'main', '--help'],
+        'module_gradient': [sys.executable, '-m', 'main', 'gradient', output,
+                            '--size', '64x64']
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    results = {}
+    for name, command in cases.items():
+        samples = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            subprocess.run(command, cwd=folder, check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start_time)
+        results[name] = {'min': min(samples), 'p50': percentile(samples, 50)}
+        print(f"{name:>16}: min {results[name]['min']*1000:.0f} мс, "
+              f"p50 {results[name]['p50']*1000:.0f} мс")
+    return results
+
+def main(argv=None):
+    """Точка входа: без аргументов - все демонстрации, иначе подкоманда"""
+    run_cli_command(sys.argv[1:] if argv is None else argv)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()